@@ -0,0 +1,62 @@
+# Import time budget of the rendering core.
+#
+# Imports each core module in a fresh interpreter, several times, and reports its best import
+# time. Fails if a module is over the budget, or if the core imports the GUI or a module that
+# should only be imported on use (NumPy for linear images, multiprocessing for process pools):
+#
+#   python benchmarks/bench_import.py
+#   python benchmarks/bench_import.py --budget 200 --repeat 10
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+# Modules of the rendering core, importable without the GUI
+CORE_MODULES = ["catalog", "parameters", "special_objects", "layout", "drawing", "mosaic", "utils",
+                "export", "pyramid", "storage", "cli"]
+# Modules the core must not import, and the core modules allowed to import them
+LAZY_MODULES = {"flet": [], "numpy": [], "multiprocessing": ["cli"]}
+# Default budget in milliseconds of the import of any core module, dependencies included
+IMPORT_BUDGET_MS = 150.0
+
+# Import the module in a fresh interpreter, returns its import time in milliseconds and the
+# lazy modules it imported
+def measure_import(module: str) -> tuple[float, list[str]]:
+    code = ("import sys, time, json\n"
+            "start = time.perf_counter()\n"
+            f"import {module}\n"
+            "elapsed = (time.perf_counter() - start) * 1000\n"
+            f"print(json.dumps([elapsed, [m for m in {list(LAZY_MODULES)!r} if m in sys.modules]]))\n")
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=SRC_FOLDER, text=True)
+    elapsed, imported = json.loads(output.strip().splitlines()[-1])
+    return elapsed, imported
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Check the import time budget of the Astro Catalog rendering core.")
+    parser.add_argument("--budget", type=float, default=IMPORT_BUDGET_MS, help="Budget in milliseconds per module")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for module in CORE_MODULES:
+        results = [measure_import(module) for _ in range(max(1, args.repeat))]
+        best = min(elapsed for elapsed, _ in results)
+        imported = [name for name in results[0][1] if module not in LAZY_MODULES[name]]
+        status = "ok"
+        if best > args.budget:
+            status = "over budget"
+        if imported:
+            status = f"imports {', '.join(imported)}"
+        if status != "ok":
+            failed += 1
+        print(f"{module:<16} {best:7.1f} ms  {status}")
+
+    print(f"{len(CORE_MODULES) - failed} of {len(CORE_MODULES)} module(s) within the {args.budget:.0f} ms budget.")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# Benchmark of the render pipeline on synthetic input folders.
+#
+# Generates input folders of the given image count, size, format and duplicate rate, then times
+# every stage (scan, decode, thumbnails with a cold and a warm cache, layout, draw_grid,
+# build_mosaic with a cold and a warm cache, and preview encoding) for each combination of scale, columns and layout mode.
+# Each case runs in a fresh process so its peak RSS is its own. Results are written as JSON
+# and two result files can be compared:
+#
+#   python benchmarks/bench_render.py --output before.json
+#   python benchmarks/bench_render.py --output after.json
+#   python benchmarks/bench_render.py --compare before.json after.json
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_FOLDER)
+
+from PIL import Image, ImageDraw
+import PIL
+from catalog import Catalog
+from layout import compute_grid_rows, compute_tiles, draw_grid, get_slot_sizes
+from mosaic import build_mosaic, get_mosaic_dimensions, load_fonts
+from parameters import LayoutMode, LoadingMode, Parameters, ResamplingQuality
+from utils import PreviewEncoder, find_images, load_images, load_thumbnails, pil_to_base64
+from thumbnail_cache import ThumbnailCache
+
+FORMATS = {"jpeg": ".jpg", "png": ".png", "tiff16": ".tif"}
+
+# Generate a reproducible synthetic image: gradient background, seeded noise and a few bright blobs
+def make_image(size: tuple[int, int], format: str, rng: random.Random) -> Image.Image:
+    w, h = size
+    noise = Image.frombytes("L", (w, h), rng.randbytes(w * h))
+    gradient = Image.linear_gradient("L").resize((w, h))
+    base = Image.blend(noise, gradient, 0.5)
+    if format == "tiff16":
+        return base.convert("I").point(lambda v: v * 256).convert("I;16")
+    image = Image.merge("RGB", (base, base.rotate(90, expand=False), gradient))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x, y, r = rng.randrange(w), rng.randrange(h), rng.randrange(5, max(6, min(w, h) // 8))
+        draw.ellipse([x - r, y - r, x + r, y + r], fill=(rng.randrange(256), rng.randrange(256), 255))
+    return image
+
+# Generate an input folder with one image per object, plus duplicates of some numbers
+def generate_folder(folder: str, prefix: str, count: int, size: tuple[int, int], format: str, duplicates: float, seed: int):
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    extension = FORMATS[format]
+    for num in range(1, count + 1):
+        names = [f"{prefix}{num}{extension}"]
+        if rng.random() < duplicates:
+            names.append(f"{prefix}{num}_v2{extension}")
+        for name in names:
+            make_image(size, format, rng).save(os.path.join(folder, name))
+
+# Peak resident memory of the current process in bytes, None if not available
+def get_peak_rss() -> int | None:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def timed(stages: dict[str, float], name: str, func: Callable[[], Any]) -> Any:
+    start = time.perf_counter()
+    result = func()
+    stages[name] = time.perf_counter() - start
+    return result
+
+# Run one case, in its own process, and return its timings in seconds and peak RSS
+def run_case(case: dict[str, Any]) -> dict[str, Any]:
+    cache_dir = tempfile.mkdtemp(prefix="astro-bench-cache-")
+    try:
+        params = Parameters.default(Catalog.from_id(case["catalog"]))
+        params.input_folder = case["folder"]
+        params.scale = case["scale"]
+        params.grid_cols = case["columns"]
+        params.layout_mode = LayoutMode(case["layout"])
+        params.loading_mode = LoadingMode(case["loading"])
+        params.resampling_quality = ResamplingQuality(case["quality"])
+        quality = params.resampling_quality
+        workers = params.get_loading_workers()
+        prefix = params.catalog.prefix()
+        slot_sizes = get_slot_sizes(params)
+        stages: dict[str, float] = {}
+
+        selection, preferences = params.image_selection, params.get_selection_preferences()
+        paths = timed(stages, "scan", lambda: find_images(params.input_folder, prefix, selection, preferences))
+        images = timed(stages, "load_images", lambda: load_images(params.input_folder, prefix, slot_sizes, params.loading_mode, workers,
+                                                                  selection=selection, preferences=preferences))
+        del images
+        cache = ThumbnailCache(params.input_folder, cache_dir)
+        timed(stages, "thumbnails_cold", lambda: load_thumbnails(paths, slot_sizes, cache, params.loading_mode, workers, quality=quality))
+        thumbnails = timed(stages, "thumbnails_warm", lambda: load_thumbnails(paths, slot_sizes, cache, params.loading_mode, workers, quality=quality))
+
+        special_objects = params.get_special_objects()
+        grid_rows = compute_grid_rows(params.grid_cols, special_objects, params.catalog.count())
+        timed(stages, "layout", lambda: compute_tiles(params, grid_rows, special_objects))
+
+        def run_draw_grid():
+            mosaic = Image.new("RGB", get_mosaic_dimensions(params), "black")
+            draw_grid(ImageDraw.Draw(mosaic), mosaic, load_fonts(params)[0], params, grid_rows, special_objects, thumbnails)
+        timed(stages, "draw_grid", run_draw_grid)
+
+        # build_mosaic uses the thumbnails cache of the user cache directory: end to end from an
+        # empty one, then again with the thumbnails it cached
+        os.environ["ASTRO_CATALOG_CACHE_DIR"] = os.path.join(cache_dir, "build_mosaic")
+        timed(stages, "build_mosaic_cold", lambda: build_mosaic(params))
+        mosaic = timed(stages, "build_mosaic_warm", lambda: build_mosaic(params))
+        timed(stages, "pil_to_base64", lambda: pil_to_base64(mosaic))
+        timed(stages, "preview_encode", lambda: PreviewEncoder().encode(mosaic))
+
+        return {**case, "mosaic_size": list(mosaic.size), "stages": stages, "peak_rss": get_peak_rss()}
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_FOLDER, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_list(value: str, cast: Callable[[str], Any]) -> list[Any]:
+    return [cast(item) for item in value.split(",") if item]
+
+def run_benchmark(args: argparse.Namespace) -> dict[str, Any]:
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    catalog = Catalog.from_id(args.catalog)
+    root = args.data_dir or tempfile.mkdtemp(prefix="astro-bench-data-")
+    results: list[dict[str, Any]] = []
+    context = multiprocessing.get_context("spawn")
+    try:
+        for format in parse_list(args.formats, str):
+            folder = os.path.join(root, f"{catalog.id()}-{args.count}-{width}x{height}-{format}-{args.duplicates}-{args.seed}")
+            if not os.path.isdir(folder):
+                print(f"Generating {folder}...")
+                generate_folder(folder, catalog.prefix(), args.count, (width, height), format, args.duplicates, args.seed)
+            for layout in parse_list(args.layouts, str):
+                for columns in parse_list(args.columns, int):
+                    for scale in parse_list(args.scales, float):
+                        case = {"catalog": catalog.id(), "folder": folder, "format": format, "count": args.count,
+                                "size": [width, height], "duplicates": args.duplicates, "layout": layout,
+                                "columns": columns, "scale": scale, "loading": args.loading, "quality": args.quality}
+                        for repeat in range(args.repeat):
+                            with context.Pool(1, maxtasksperchild=1) as pool:
+                                result = pool.apply(run_case, (case,))
+                            result["repeat"] = repeat
+                            results.append(result)
+                            total = sum(result["stages"].values())
+                            print(f"{format} {layout} cols={columns} scale={scale} #{repeat}: {total:.2f}s, "
+                                  f"peak RSS {(result['peak_rss'] or 0) / 2 ** 20:.0f} MB")
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+
+# Key identifying a case across result files
+def case_key(result: dict[str, Any]) -> tuple[Any, ...]:
+    return (result["format"], result["layout"], result["columns"], result["scale"], result["count"],
+            tuple(result["size"]), result["duplicates"], result["loading"], result.get("quality", ResamplingQuality.PRINT.value))
+
+# Print the best time of each stage of both files and their ratio
+def compare(before_file: str, after_file: str):
+    def best_times(file: str) -> dict[tuple[Any, ...], dict[str, float]]:
+        with open(file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        best: dict[tuple[Any, ...], dict[str, float]] = {}
+        for result in data["results"]:
+            stages = best.setdefault(case_key(result), {})
+            for stage, seconds in result["stages"].items():
+                stages[stage] = min(seconds, stages.get(stage, seconds))
+        return best
+
+    before, after = best_times(before_file), best_times(after_file)
+    for key in sorted(set(before) & set(after), key=str):
+        print(" ".join(str(k) for k in key[:4]))
+        for stage, seconds in after[key].items():
+            if stage in before[key]:
+                ratio = seconds / before[key][stage] if before[key][stage] else float("inf")
+                print(f"    {stage:<18} {before[key][stage]:8.3f}s -> {seconds:8.3f}s  x{ratio:.2f}")
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the Astro Catalog render pipeline.")
+    parser.add_argument("--catalog", default="messier")
+    parser.add_argument("--count", type=int, default=110, help="Number of objects with an image")
+    parser.add_argument("--size", default="1600x1200", help="Pixel size of the generated images")
+    parser.add_argument("--formats", default="jpeg,png,tiff16", help="Comma separated: jpeg, png, tiff16")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="Rate of numbers with a second image")
+    parser.add_argument("--scales", default="1,2,5,10")
+    parser.add_argument("--columns", default="17,25")
+    parser.add_argument("--layouts", default=",".join(mode.value for mode in LayoutMode))
+    parser.add_argument("--loading", default=LoadingMode.THREADS.value, choices=[mode.value for mode in LoadingMode])
+    parser.add_argument("--quality", default=ResamplingQuality.PRINT.value, choices=[quality.value for quality in ResamplingQuality])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", help="Keep the generated folders in this directory to reuse them")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two result files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    data = run_benchmark(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    print(f"Results written to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
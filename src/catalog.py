@@ -1,25 +1,115 @@
-from enum import Enum
+import json
+import os
+from special_objects import SpecialObject
 
-# Define the catalogs with their prefixes, titles, and counts
-class Catalog(Enum):
-    MESSIER = ("messier", "M", "Messier Catalog", 110)
-    CALDWELL = ("caldwell", "C", "Caldwell Catalog", 109)
+# Catalogs are defined in data files: catalogs.json lists the id, prefix, title and object count
+# of every catalog, and an optional data file per catalog holds its default layout and, for
+# catalogs whose numbers are not 1 to count, the list of its object numbers.
+# Data files are only parsed the first time a catalog needs them.
+CATALOGS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "catalogs")
+CATALOGS_INDEX_FILE = "catalogs.json"
+DEFAULT_CATALOG_ID = "messier"
+
+# Expand a compact list of numbers like [1, 5, "10-20"] into sorted unique numbers
+def parse_numbers(items: list[int | str]) -> tuple[int, ...]:
+    numbers: set[int] = set()
+    for item in items:
+        if isinstance(item, int):
+            numbers.add(item)
+        else:
+            first, _, last = str(item).partition("-")
+            numbers.update(range(int(first), int(last or first) + 1))
+    return tuple(sorted(numbers))
+
+class Catalog:
+    __slots__ = ("_id", "_prefix", "_title", "_count", "_data_file", "_data")
+
+    # Catalogs by id, in the order of the index file, loaded on first use
+    _registry: dict[str, "Catalog"] | None = None
+
+    def __init__(self, id: str, prefix: str, title: str, count: int, data_file: str | None = None):
+        self._id = id
+        self._prefix = prefix
+        self._title = title
+        self._count = count
+        self._data_file = data_file
+        self._data: dict[str, list[int | str] | list[dict[str, list[int] | int]]] | None = None
 
     def id(self) -> str:
-        return self.value[0]
+        return self._id
 
     def prefix(self) -> str:
-        return self.value[1]
+        return self._prefix
 
     def title(self) -> str:
-        return self.value[2]
+        return self._title
 
     def count(self) -> int:
-        return self.value[3]
-    
-    @staticmethod
-    def from_id(id: str) -> "Catalog":
-        for catalog in Catalog:
-            if catalog.id() == id:
-                return catalog
-        return Catalog.MESSIER  # Default to MESSIER if not found
+        return self._count
+
+    def load_data(self) -> dict[str, list[int | str] | list[dict[str, list[int] | int]]]:
+        if self._data is None:
+            self._data = {}
+            if self._data_file:
+                path = os.path.join(CATALOGS_FOLDER, self._data_file)
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        self._data = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"Error loading catalog data {path}: {e}")
+            if "numbers" in self._data:
+                # Keep the expanded numbers instead of the compact list
+                self._data["numbers"] = list(parse_numbers(self._data["numbers"]))  # type: ignore[arg-type]
+        return self._data
+
+    # Object numbers of the catalog, in catalog order
+    def numbers(self) -> list[int] | range:
+        numbers = self.load_data().get("numbers")
+        if numbers is None:
+            return range(1, self._count + 1)
+        return numbers  # type: ignore[return-value]
+
+    # New copy of the default layout of the catalog, empty if it has none
+    def default_layout(self) -> list[SpecialObject]:
+        layout = self.load_data().get("layout", [])
+        return [SpecialObject.from_dict(obj) for obj in layout if isinstance(obj, dict)]
+
+    def __repr__(self):
+        return f"Catalog({self._id!r})"
+
+    # Catalogs are shared singletons, copies and pickles refer to the registered instance
+    def __copy__(self) -> "Catalog":
+        return self
+
+    def __deepcopy__(self, memo: dict[int, object]) -> "Catalog":
+        return self
+
+    def __reduce__(self):
+        return (Catalog.from_id, (self._id,))
+
+    @classmethod
+    def registry(cls) -> dict[str, "Catalog"]:
+        if cls._registry is None:
+            registry: dict[str, Catalog] = {}
+            with open(os.path.join(CATALOGS_FOLDER, CATALOGS_INDEX_FILE), "r", encoding="utf-8") as f:
+                for entry in json.load(f):
+                    catalog = cls(id=str(entry["id"]),
+                                  prefix=str(entry["prefix"]),
+                                  title=str(entry["title"]),
+                                  count=int(entry["count"]),
+                                  data_file=entry.get("data"))
+                    registry[catalog.id()] = catalog
+            cls._registry = registry
+        return cls._registry
+
+    @classmethod
+    def all(cls) -> list["Catalog"]:
+        return list(cls.registry().values())
+
+    @classmethod
+    def default(cls) -> "Catalog":
+        return cls.registry()[DEFAULT_CATALOG_ID]
+
+    @classmethod
+    def from_id(cls, id: str) -> "Catalog":
+        return cls.registry().get(id) or cls.default()  # Default to Messier if not found
@@ -0,0 +1,164 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from export import save_mosaic
+from layout import get_slot_sizes
+from parameters import LoadingMode, Parameters
+from pyramid import PYRAMID_TILE_FORMATS, PyramidLayout, export_pyramid
+from utils import estimate_thumbnail_memory, find_images, load_images
+
+# Headless renderer: renders one mosaic per parameters JSON file (the format saved by the app,
+# see Parameters.to_json) across a process pool. Jobs using the same input folder and catalog
+# are split into as many batches as the processes they get, each batch decodes the folder once
+# and renders its jobs from it.
+#
+# Example: python src/cli.py jobs/ messier.json --output-dir posters --workers 4
+#
+# With --tiles, each mosaic is exported as a DZI or XYZ tile pyramid instead, named like its
+# output file. With --incremental, only the tiles whose grid cells changed are rewritten.
+
+# A job is the parameters JSON and the output file
+Job = tuple[str, str]
+
+# Split the jobs of each group into batches so the jobs are spread over the workers: each group
+# gets a share of the workers proportional to its number of jobs, at least one
+def split_groups(groups: list[list[Job]], workers: int) -> list[list[Job]]:
+    jobs_count = sum(len(jobs) for jobs in groups)
+    batches: list[list[Job]] = []
+    for jobs in groups:
+        parts = max(1, min(len(jobs), -(-workers * len(jobs) // jobs_count)))
+        size = -(-len(jobs) // parts)
+        batches.extend(jobs[i:i + size] for i in range(0, len(jobs), size))
+    return batches
+
+# Find the parameters files of the given paths, directories are searched for *.json files
+def find_parameters_files(paths: list[str]) -> list[str]:
+    files: list[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.lower().endswith(".json"))
+        else:
+            files.append(path)
+    return files
+
+# Read a parameters file and resolve its output file
+def read_job(path: str, output_dir: str | None) -> tuple[Parameters, str]:
+    with open(path, "r", encoding="utf-8") as f:
+        params = Parameters.from_json(f.read())
+    output_file = params.output_file or os.path.splitext(os.path.basename(path))[0] + ".png"
+    if output_dir:
+        output_file = os.path.join(output_dir, os.path.basename(output_file))
+    elif not os.path.isabs(output_file):
+        output_file = os.path.join(os.path.dirname(os.path.abspath(path)), output_file)
+    return params, output_file
+
+# Render the jobs of one input folder, catalog, stretch and image selection, decoding the folder
+# once for all of them if the decoded images fit in the memory limit, else each job streams its
+# images from the files.
+# Runs in a worker process, returns the error message of each job or None if it succeeded.
+# With a pyramid layout, the jobs are exported as tile pyramids.
+def render_group(jobs: list[Job],
+                 loading_workers: int,
+                 pyramid: PyramidLayout | None = None,
+                 tile_format: str = "jpg",
+                 incremental: bool = False) -> list[tuple[str, str | None]]:
+    all_params = [Parameters.from_json(params_json) for params_json, _ in jobs]
+    first = all_params[0]
+
+    # Decode at the largest slot any job needs so the JPEG draft stays large enough for all
+    slot_sizes: dict[int, tuple[int, int]] = {}
+    for params in all_params:
+        for num, (w, h) in get_slot_sizes(params).items():
+            max_w, max_h = slot_sizes.get(num, (0, 0))
+            slot_sizes[num] = (max(w, max_w), max(h, max_h))
+    paths = find_images(first.input_folder, first.catalog.prefix(), first.image_selection, first.get_selection_preferences())
+    memory = sum(estimate_thumbnail_memory(path, slot_sizes[num]) for num, path in paths.items() if num in slot_sizes)
+    memory_limit = first.get_memory_limit_bytes()
+    sources: dict[int, Image.Image] | None = None
+    if len(jobs) > 1 and (memory_limit == 0 or memory <= memory_limit):
+        sources = load_images(first.input_folder,
+                              first.catalog.prefix(),
+                              slot_sizes,
+                              LoadingMode.THREADS,
+                              loading_workers,
+                              stretch=first.stretch_mode,
+                              selection=first.image_selection,
+                              preferences=first.get_selection_preferences())
+
+    results: list[tuple[str, str | None]] = []
+    for params, (_, output_file) in zip(all_params, jobs):
+        # The CPUs are shared by the worker processes
+        if params.fit_workers <= 0:
+            params.fit_workers = loading_workers
+        start = time.perf_counter()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+            if pyramid is not None:
+                export_pyramid(params, output_file, pyramid, tile_format, incremental, loading_workers, sources=sources)
+            else:
+                save_mosaic(params, output_file, sources)
+            print(f"Saved {output_file} in {time.perf_counter() - start:.1f}s")
+            results.append((output_file, None))
+        except Exception as e:
+            results.append((output_file, str(e)))
+    return results
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Render Astro Catalog mosaics without the GUI.")
+    parser.add_argument("paths", nargs="+", help="Parameters JSON files or directories of JSON files")
+    parser.add_argument("--output-dir", help="Directory of the rendered files, instead of the output file of each JSON")
+    parser.add_argument("--input-folder", help="Images folder used by every job, instead of the one of each JSON")
+    parser.add_argument("--workers", type=int, default=0, help="Number of processes, 0 for one per CPU")
+    parser.add_argument("--tiles", choices=[layout.value.lower() for layout in PyramidLayout], help="Export tile pyramids instead of images")
+    parser.add_argument("--tile-format", choices=list(PYRAMID_TILE_FORMATS), default="jpg", help="Image format of the tiles")
+    parser.add_argument("--incremental", action="store_true", help="Only rewrite the tiles that changed since the previous export")
+    args = parser.parse_args(argv)
+    pyramid = PyramidLayout(args.tiles.upper()) if args.tiles else None
+
+    # Group the jobs by input folder, catalog, stretch and image selection to share their decoded images
+    groups: dict[tuple[str, str, str, str, tuple[str, ...]], list[Job]] = {}
+    for path in find_parameters_files(args.paths):
+        try:
+            params, output_file = read_job(path, args.output_dir)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error reading {path}: {e}")
+            return 1
+        if args.input_folder:
+            params.input_folder = args.input_folder
+        if pyramid is not None:
+            output_file = os.path.splitext(output_file)[0] + (".dzi" if pyramid == PyramidLayout.DZI else "")
+        key = (os.path.abspath(params.input_folder), params.catalog.id(), params.stretch_mode.value,
+               params.image_selection.value, tuple(params.get_selection_preferences()))
+        groups.setdefault(key, []).append((params.to_json(), output_file))
+
+    if not groups:
+        print("No parameters file found.")
+        return 1
+
+    cpu_count = os.cpu_count() or 1
+    jobs_count = sum(len(jobs) for jobs in groups.values())
+    workers = min(args.workers if args.workers > 0 else cpu_count, jobs_count)
+    batches = split_groups(list(groups.values()), workers)
+    workers = min(workers, len(batches))
+    loading_workers = max(1, cpu_count // workers)
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(render_group, jobs, loading_workers, pyramid, args.tile_format, args.incremental)
+                   for jobs in batches]
+        for future in futures:
+            for output_file, error in future.result():
+                if error is not None:
+                    print(f"Error rendering {output_file}: {error}")
+                    failed += 1
+
+    print(f"Rendered {jobs_count - failed} of {jobs_count} mosaic(s) in {time.perf_counter() - start:.1f}s.")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -1,34 +1,103 @@
-from PIL import ImageDraw, ImageFont
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageDraw
+from fonts import FONT_LOCK, Font
+
+# Labels are rasterised once per text and font into a sprite, an alpha mask of the text
+# composited in white on the mosaic. Fonts are cached per path and size so a sprite is shared
+# by every render using the same label.
+# The sprites are kept per font within a byte budget, the sprites of the fonts used least recently
+# are evicted first. Once the font being drawn fills the budget by itself, its new sprites are not kept: a
+# render walking a whole catalog still reuses the sprites kept by the previous one instead of
+# evicting them, and the labels of large exports don't hold memory after the export.
+LABEL_SPRITES_MAX_BYTES = 64 * 1024 * 1024
+
+Sprite = tuple[Image.Image, tuple[int, int, int, int]]
+
+label_sprites: OrderedDict[Font, dict[str, Sprite]] = OrderedDict()
+label_sprites_bytes = 0
+# Last sprite not kept in the budget, a label is measured then drawn with the same font
+last_label_sprite: tuple[Font, str, Sprite] | None = None
+label_sprites_lock = threading.Lock()
+
+def get_sprite_bytes(sprite: Sprite) -> int:
+    return sprite[0].width * sprite[0].height
+
+def render_label_sprite(text: str, font: Font) -> Sprite:
+    with FONT_LOCK:
+        bbox = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox((0, 0), text, font=font)
+        left, top, right, bottom = (int(v) for v in bbox)
+        sprite = Image.new("L", (max(1, right - left), max(1, bottom - top)), 0)
+        ImageDraw.Draw(sprite).text((-left, -top), text, fill=255, font=font)
+    return sprite, (left, top, right, bottom)
+
+def get_label_sprite(text: str, font: Font) -> Sprite:
+    global label_sprites_bytes, last_label_sprite
+    with label_sprites_lock:
+        sprites = label_sprites.get(font)
+        if sprites is not None:
+            label_sprites.move_to_end(font)
+            sprite = sprites.get(text)
+            if sprite is not None:
+                return sprite
+        if last_label_sprite is not None and last_label_sprite[0] == font and last_label_sprite[1] == text:
+            return last_label_sprite[2]
+    sprite = render_label_sprite(text, font)
+    size = get_sprite_bytes(sprite)
+    with label_sprites_lock:
+        # Make room with the sprites of the other fonts, least recently used font first
+        while label_sprites_bytes + size > LABEL_SPRITES_MAX_BYTES:
+            oldest = next(iter(label_sprites), None)
+            if oldest is None or oldest == font:
+                last_label_sprite = font, text, sprite
+                return sprite
+            oldest_sprites = label_sprites[oldest]
+            _, evicted = oldest_sprites.popitem()
+            label_sprites_bytes -= get_sprite_bytes(evicted)
+            if not oldest_sprites:
+                del label_sprites[oldest]
+        sprites = label_sprites.setdefault(font, {})
+        label_sprites.move_to_end(font)
+        if text not in sprites:
+            sprites[text] = sprite
+            label_sprites_bytes += size
+    return sprite
+
+# Size of the text as measured by ImageDraw.textbbox from (0, 0)
+def get_label_size(text: str, font: Font) -> tuple[int, int]:
+    _, (left, top, right, bottom) = get_label_sprite(text, font)
+    return right - left, bottom - top
+
+# Draw the text in white with its origin at (x, y), like ImageDraw.text
+def draw_label(image: Image.Image, text: str, font: Font, x: int, y: int):
+    sprite, (left, top, right, bottom) = get_label_sprite(text, font)
+    if right > left and bottom > top:
+        image.paste("white", (x + left, y + top), sprite)
 
 # Draw the title at the top center of the mosaic
-def draw_title(draw: ImageDraw.ImageDraw, 
-               text: str, 
-               font: ImageFont.ImageFont | ImageFont.FreeTypeFont, 
-               mosaic_w: int, 
-               title_row_height: int, 
-               padding: int):
-    bbox = draw.textbbox((0, 0), text, font=font)
-    tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
+# y_offset is the top of the drawn area when only a band of the mosaic is drawn
+def draw_title(image: Image.Image,
+               text: str,
+               font: Font,
+               mosaic_w: int,
+               title_row_height: int,
+               padding: int,
+               y_offset: int = 0):
+    tw, th = get_label_size(text, font)
     x = (mosaic_w - tw) // 2
-    y = padding + (title_row_height - th) // 2
-    draw.text((x, y), text, fill="white", font=font)
+    y = padding + (title_row_height - th) // 2 - y_offset
+    draw_label(image, text, font, x, y)
 
 # Draw the progress text at the bottom right of the mosaic
-def draw_progress(draw: ImageDraw.ImageDraw, 
-                  text: str, 
-                  font: ImageFont.ImageFont | ImageFont.FreeTypeFont, 
-                  col: int, 
-                  row: int, 
-                  padding: int, 
-                  thumb_size: int):
+def draw_progress(image: Image.Image,
+                  text: str,
+                  font: Font,
+                  col: int,
+                  row: int,
+                  padding: int,
+                  thumb_size: int,
+                  y_offset: int = 0):
     x = col * thumb_size + padding
-    y = row * thumb_size + padding
-    bbox = draw.textbbox((0, 0), text, font=font)
-    tw = bbox[2] - bbox[0]
-    th = bbox[3] - bbox[1]
-    draw.text(
-        (x + (thumb_size - tw) // 2, y + (thumb_size - th) // 2),
-        text,
-        fill="white",
-        font=font
-    )
+    y = row * thumb_size + padding - y_offset
+    tw, th = get_label_size(text, font)
+    draw_label(image, text, font, x + (thumb_size - tw) // 2, y + (thumb_size - th) // 2)
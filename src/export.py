@@ -0,0 +1,299 @@
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, BinaryIO, Callable
+from PIL import Image
+from mosaic import BAND_ROWS, build_mosaic, get_mosaic_dimensions, render_bands
+from metrics import RenderMetrics, measure
+from parameters import Parameters
+from pyramid import export_pyramid
+from utils import atomic_output
+
+# Mosaics above this number of pixels are rendered in bands when saved as PNG or TIFF
+BAND_EXPORT_MIN_PIXELS = 64 * 1000 * 1000
+TIFF_ROWS_PER_STRIP = 64
+PNG_COMPRESS_LEVEL = 6
+# Above this size the 32 bits offsets of a classic TIFF file are not enough
+BIGTIFF_MIN_BYTES = 2 ** 32 - 2 ** 24
+# Uncompressed bytes of PNG image data compressed per task, and the deflate window
+PNG_BLOCK_SIZE = 1024 * 1024
+DEFLATE_WINDOW = 32 * 1024
+# Blocks or strips being compressed per worker, bounds the memory held by the queue
+ENCODE_QUEUE_PER_WORKER = 2
+
+# Called with the fraction of the export done, from the exporting thread
+ProgressCallback = Callable[[float], None]
+
+# Runs encoding tasks on the executor, or inline without one, and passes their results to write
+# in submission order as they complete. The number of tasks in flight is bounded.
+class OrderedEncoder:
+    def __init__(self, write: Callable[[Any], None], executor: Executor | None = None, workers: int = 1):
+        self.write = write
+        self.executor = executor
+        self.max_pending = max(1, workers) * ENCODE_QUEUE_PER_WORKER
+        self.pending: deque[Future[Any]] = deque()
+
+    def submit(self, func: Callable[..., Any], *args: Any):
+        if self.executor is None:
+            self.write(func(*args))
+            return
+        while len(self.pending) >= self.max_pending:
+            self.write(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(func, *args))
+
+    def flush(self):
+        while self.pending:
+            self.write(self.pending.popleft().result())
+
+# Header of a zlib stream compressed at the level, with the default 32 KB window
+def get_zlib_header(level: int) -> bytes:
+    level = 6 if level < 0 else level
+    flevel = 0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3
+    cmf, flg = 0x78, flevel << 6
+    return bytes((cmf, flg + 31 - (cmf * 256 + flg) % 31))
+
+# Compress a block of a deflate stream on its own, like pigz: primed with the end of the previous
+# block as dictionary, so matches still reach back into it, and ended on a byte boundary by a
+# sync flush, so blocks compressed in parallel concatenate into a single stream
+def deflate_block(data: bytes, dictionary: bytes, level: int, last: bool) -> bytes:
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+# Writes an 8 bits RGB PNG file row by row. The image data is compressed in blocks, on the
+# executor if given, each block written as an IDAT chunk once it and the previous ones are done.
+class StreamingPngWriter:
+    def __init__(self,
+                 file: BinaryIO,
+                 width: int,
+                 height: int,
+                 compress_level: int = PNG_COMPRESS_LEVEL,
+                 executor: Executor | None = None,
+                 workers: int = 1):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.compress_level = compress_level
+        self.rows_written = 0
+        self.pending = bytearray()
+        self.dictionary = b""
+        self.checksum = zlib.adler32(b"")
+        self.encoder = OrderedEncoder(lambda data: self.write_chunk(b"IDAT", data), executor, workers)
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        # Width, height, bit depth, color type (RGB), compression, filter and interlace methods
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        self.write_chunk(b"IDAT", get_zlib_header(compress_level))
+
+    def write_chunk(self, chunk_type: bytes, data: bytes):
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write_rows(self, image: Image.Image):
+        stride = self.width * 3
+        raw = image.convert("RGB").tobytes()
+        # Each row starts with its filter type, 0 for none
+        rows = b"".join(b"\x00" + raw[i:i + stride] for i in range(0, len(raw), stride))
+        self.checksum = zlib.adler32(rows, self.checksum)
+        self.pending += rows
+        self.rows_written += image.height
+        while len(self.pending) >= PNG_BLOCK_SIZE:
+            self.compress_block(bytes(self.pending[:PNG_BLOCK_SIZE]), False)
+            del self.pending[:PNG_BLOCK_SIZE]
+
+    def compress_block(self, data: bytes, last: bool):
+        self.encoder.submit(deflate_block, data, self.dictionary, self.compress_level, last)
+        self.dictionary = (self.dictionary + data)[-DEFLATE_WINDOW:]
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError(f"PNG expects {self.height} rows, {self.rows_written} written")
+        self.compress_block(bytes(self.pending), True)
+        self.pending.clear()
+        self.encoder.flush()
+        self.write_chunk(b"IDAT", struct.pack(">I", self.checksum))
+        self.write_chunk(b"IEND", b"")
+
+# Writes an 8 bits RGB TIFF file strip by strip, optionally compressed with deflate.
+# Strips are encoded as soon as they are complete, on the executor if given, and written in order,
+# the directory is written on close, as a BigTIFF file if the image may not fit in a classic TIFF file.
+class StripTiffWriter:
+    SHORT = 3
+    LONG = 4
+    LONG8 = 16
+
+    def __init__(self,
+                 file: BinaryIO,
+                 width: int,
+                 height: int,
+                 rows_per_strip: int = TIFF_ROWS_PER_STRIP,
+                 compress: bool = True,
+                 bigtiff: bool | None = None,
+                 executor: Executor | None = None,
+                 workers: int = 1):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.rows_per_strip = rows_per_strip
+        self.compress = compress
+        self.bigtiff = bigtiff if bigtiff is not None else width * height * 3 >= BIGTIFF_MIN_BYTES
+        self.pending = bytearray()
+        self.rows_written = 0
+        self.strip_offsets: list[int] = []
+        self.strip_byte_counts: list[int] = []
+        self.encoder = OrderedEncoder(self.write_encoded_strip, executor, workers)
+        if self.bigtiff:
+            self.file.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+            self.ifd_pointer_position = 8
+        else:
+            self.file.write(b"II" + struct.pack("<HI", 42, 0))
+            self.ifd_pointer_position = 4
+
+    def write_rows(self, image: Image.Image):
+        self.pending += image.convert("RGB").tobytes()
+        self.rows_written += image.height
+        strip_bytes = self.rows_per_strip * self.width * 3
+        while len(self.pending) >= strip_bytes:
+            self.write_strip(bytes(self.pending[:strip_bytes]))
+            del self.pending[:strip_bytes]
+
+    def encode_strip(self, strip: bytes) -> bytes:
+        return zlib.compress(strip) if self.compress else strip
+
+    # Encode the strip, on a worker thread with an executor
+    def write_strip(self, strip: bytes):
+        self.encoder.submit(self.encode_strip, strip)
+
+    def write_encoded_strip(self, data: bytes):
+        self.strip_offsets.append(self.file.tell())
+        self.strip_byte_counts.append(len(data))
+        self.file.write(data)
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError(f"TIFF expects {self.height} rows, {self.rows_written} written")
+        if self.pending:
+            self.write_strip(bytes(self.pending))
+            self.pending.clear()
+        self.encoder.flush()
+        self.write_directory()
+
+    def write_directory(self):
+        offset_type = self.LONG8 if self.bigtiff else self.LONG
+        entries: list[tuple[int, int, list[int]]] = [
+            (256, self.LONG, [self.width]),                     # ImageWidth
+            (257, self.LONG, [self.height]),                    # ImageLength
+            (258, self.SHORT, [8, 8, 8]),                       # BitsPerSample
+            (259, self.SHORT, [8 if self.compress else 1]),     # Compression
+            (262, self.SHORT, [2]),                             # PhotometricInterpretation (RGB)
+            (273, offset_type, self.strip_offsets),             # StripOffsets
+            (277, self.SHORT, [3]),                             # SamplesPerPixel
+            (278, self.LONG, [self.rows_per_strip]),            # RowsPerStrip
+            (279, offset_type, self.strip_byte_counts),         # StripByteCounts
+            (284, self.SHORT, [1]),                             # PlanarConfiguration (contiguous)
+        ]
+        formats = {self.SHORT: "H", self.LONG: "I", self.LONG8: "Q"}
+        inline_size = 8 if self.bigtiff else 4
+
+        # Values that don't fit in their entry are written before the directory
+        packed_entries: list[tuple[int, int, int, bytes]] = []
+        for tag, value_type, values in entries:
+            data = struct.pack(f"<{len(values)}{formats[value_type]}", *values)
+            if len(data) > inline_size:
+                self.align()
+                offset = self.file.tell()
+                self.file.write(data)
+                data = struct.pack("<Q" if self.bigtiff else "<I", offset)
+            packed_entries.append((tag, value_type, len(values), data.ljust(inline_size, b"\x00")))
+
+        self.align()
+        ifd_offset = self.file.tell()
+        if self.bigtiff:
+            self.file.write(struct.pack("<Q", len(packed_entries)))
+            for tag, value_type, count, data in packed_entries:
+                self.file.write(struct.pack("<HHQ", tag, value_type, count) + data)
+            self.file.write(struct.pack("<Q", 0))
+        else:
+            self.file.write(struct.pack("<H", len(packed_entries)))
+            for tag, value_type, count, data in packed_entries:
+                self.file.write(struct.pack("<HHI", tag, value_type, count) + data)
+            self.file.write(struct.pack("<I", 0))
+
+        self.file.seek(self.ifd_pointer_position)
+        self.file.write(struct.pack("<Q" if self.bigtiff else "<I", ifd_offset))
+        self.file.seek(0, os.SEEK_END)
+
+    def align(self):
+        if self.file.tell() % 2:
+            self.file.write(b"\x00")
+
+# Whether the mosaic is saved by rendering it in bands
+def use_band_export(params: Parameters, output_file: str) -> bool:
+    mosaic_w, mosaic_h = get_mosaic_dimensions(params)
+    extension = os.path.splitext(output_file)[1].lower()
+    return mosaic_w * mosaic_h >= BAND_EXPORT_MIN_PIXELS and extension in (".png", ".tif", ".tiff")
+
+# Render the mosaic band by band and write each band straight to a PNG or TIFF file,
+# peak memory is bounded by the band height instead of the mosaic size.
+# The compression runs on the loading workers of the parameters while the next band renders.
+def export_bands(params: Parameters,
+                 output_file: str,
+                 band_rows: int = BAND_ROWS,
+                 sources: dict[int, Image.Image] | None = None,
+                 metrics: RenderMetrics | None = None,
+                 on_progress: ProgressCallback | None = None):
+    mosaic_w, mosaic_h = get_mosaic_dimensions(params)
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension not in (".png", ".tif", ".tiff"):
+        raise ValueError(f"Band export only supports PNG and TIFF files, not '{extension}'")
+    workers = params.get_loading_workers()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encode") if workers > 1 else None
+    try:
+        with atomic_output(output_file) as tmp_file, open(tmp_file, "wb") as file:
+            writer: StreamingPngWriter | StripTiffWriter
+            if extension == ".png":
+                writer = StreamingPngWriter(file, mosaic_w, mosaic_h, executor=executor, workers=workers)
+            else:
+                writer = StripTiffWriter(file, mosaic_w, mosaic_h, executor=executor, workers=workers)
+            for band in render_bands(params, band_rows, sources, metrics):
+                with measure(metrics, "encode"):
+                    writer.write_rows(band)
+                if on_progress is not None:
+                    on_progress(writer.rows_written / mosaic_h)
+            with measure(metrics, "encode"):
+                writer.close()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+# Save the mosaic at full scale, rendering it in bands if it is large.
+# A .dzi output file is exported as a Deep Zoom tile pyramid, incrementally if asked.
+# Image files are written to a temporary file renamed once complete, an existing file is only
+# replaced by a complete one.
+def save_mosaic(params: Parameters,
+                output_file: str,
+                sources: dict[int, Image.Image] | None = None,
+                metrics: RenderMetrics | None = None,
+                incremental: bool = False,
+                on_progress: ProgressCallback | None = None):
+    if output_file.lower().endswith(".dzi"):
+        export_pyramid(params, output_file, incremental=incremental, sources=sources, metrics=metrics, on_progress=on_progress)
+    elif use_band_export(params, output_file):
+        export_bands(params, output_file, sources=sources, metrics=metrics, on_progress=on_progress)
+    else:
+        image_format = Image.registered_extensions().get(os.path.splitext(output_file)[1].lower())
+        if image_format is None:
+            raise ValueError(f"Unknown image format of '{output_file}'")
+        mosaic = build_mosaic(params, sources, metrics)
+        # Rendering takes most of the time of a mosaic saved at once
+        if on_progress is not None:
+            on_progress(0.8)
+        with measure(metrics, "encode"), atomic_output(output_file) as tmp_file:
+            mosaic.save(tmp_file, format=image_format)
+        if on_progress is not None:
+            on_progress(1.0)
@@ -0,0 +1,133 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import threading
+from typing import Callable
+
+# Delay between two scans of the folder when inotify is not available
+WATCH_POLL_INTERVAL = 1.0
+# Delay without new event before the folder is scanned, so files being written are complete
+WATCH_SETTLE_DELAY = 0.5
+
+# inotify events of files added, removed, written or renamed in the folder
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+WATCH_EVENTS = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# Size and modification time of every file of the folder by name
+FolderSnapshot = dict[str, tuple[int, int]]
+
+def take_snapshot(folder: str) -> FolderSnapshot:
+    snapshot: FolderSnapshot = {}
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    continue  # Removed while scanning
+    except OSError:
+        pass
+    return snapshot
+
+# Names of the files added, removed or modified between the snapshots
+def diff_snapshots(old: FolderSnapshot, new: FolderSnapshot) -> set[str]:
+    return {name for name in old.keys() | new.keys() if old.get(name) != new.get(name)}
+
+# Open an inotify watch of the folder, returns its file descriptor or None if not available
+def open_inotify(folder: str) -> int | None:
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_EVENTS) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+# Watches a folder on a background thread and calls on_change with the names of the files
+# added, removed or modified since the last call. Uses inotify on Linux, polls elsewhere or if
+# inotify is not available. Either way the changes are found by comparing snapshots of the
+# folder, events only tell when to take one. on_change is called from the watcher thread.
+class FolderWatcher:
+    def __init__(self,
+                 folder: str,
+                 on_change: Callable[[set[str]], None],
+                 poll_interval: float = WATCH_POLL_INTERVAL,
+                 settle_delay: float = WATCH_SETTLE_DELAY):
+        self.folder = folder
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.settle_delay = settle_delay
+        self.snapshot = take_snapshot(folder)
+        self.stopped = threading.Event()
+        self.inotify_fd = open_inotify(folder)
+        self.thread = threading.Thread(target=self.run, name="folder-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def uses_inotify(self) -> bool:
+        return self.inotify_fd is not None
+
+    # Take a new snapshot and report the changes, if any
+    def check(self):
+        snapshot = take_snapshot(self.folder)
+        changed = diff_snapshots(self.snapshot, snapshot)
+        self.snapshot = snapshot
+        if changed:
+            try:
+                self.on_change(changed)
+            except Exception as e:
+                print(f"Error handling changes of '{self.folder}': {e}")
+
+    # Wait up to timeout for inotify events and drain them, returns whether there were any
+    def wait_events(self, fd: int, timeout: float) -> bool:
+        readable, _, _ = select.select([fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def run(self):
+        try:
+            if self.inotify_fd is None:
+                while not self.stopped.wait(self.poll_interval):
+                    self.check()
+                return
+            while not self.stopped.is_set():
+                # The timeout only lets the thread notice stop()
+                if not self.wait_events(self.inotify_fd, self.poll_interval):
+                    continue
+                # Wait for the burst of events of a file copy to end before scanning
+                while not self.stopped.is_set() and self.wait_events(self.inotify_fd, self.settle_delay):
+                    pass
+                if not self.stopped.is_set():
+                    self.check()
+        except OSError as e:
+            print(f"Error watching '{self.folder}': {e}")
+        finally:
+            if self.inotify_fd is not None:
+                os.close(self.inotify_fd)
@@ -0,0 +1,75 @@
+import functools
+import os
+import sys
+import threading
+from PIL import ImageFont
+
+Font = ImageFont.ImageFont | ImageFont.FreeTypeFont
+
+# Fonts used when the font of the parameters can't be loaded, in order of preference
+FALLBACK_FONT_FILES = [
+    "helveticaneue.ttc",
+    "helvetica.ttc",
+    "arial.ttf",
+    "liberationsans-regular.ttf",
+    "dejavusans.ttf",
+]
+FONT_EXTENSIONS = (".ttf", ".ttc", ".otf")
+
+# FreeType faces are not thread safe, text is measured and rasterised under this lock
+FONT_LOCK = threading.Lock()
+
+# Font folders of the platform
+def get_font_folders() -> list[str]:
+    home = os.path.expanduser("~")
+    if sys.platform == "win32":
+        windows = os.environ.get("WINDIR", "C:\\Windows")
+        folders = [os.path.join(windows, "Fonts")]
+        if os.environ.get("LOCALAPPDATA"):
+            folders.append(os.path.join(os.environ["LOCALAPPDATA"], "Microsoft", "Windows", "Fonts"))
+        return folders
+    if sys.platform == "darwin":
+        return ["/System/Library/Fonts", "/Library/Fonts", os.path.join(home, "Library", "Fonts")]
+    data_home = os.environ.get("XDG_DATA_HOME") or os.path.join(home, ".local", "share")
+    return ["/usr/share/fonts", "/usr/local/share/fonts", os.path.join(data_home, "fonts"), os.path.join(home, ".fonts")]
+
+# Index of the installed fonts by lowercase file name, built once per process
+@functools.lru_cache(maxsize=None)
+def get_font_index() -> dict[str, str]:
+    index: dict[str, str] = {}
+    for folder in get_font_folders():
+        for root, _, files in os.walk(folder):
+            for name in sorted(files):
+                if name.lower().endswith(FONT_EXTENSIONS):
+                    index.setdefault(name.lower(), os.path.join(root, name))
+    return index
+
+# Path of the font file to load for the given path: the path itself if it exists, else an
+# installed font with the same file name, else the first installed fallback font.
+# Returns None if none is found, the default font of Pillow is used then.
+@functools.lru_cache(maxsize=None)
+def resolve_font_path(font_path: str) -> str | None:
+    if font_path and os.path.isfile(font_path):
+        return font_path
+    index = get_font_index()
+    name = os.path.basename(font_path).lower()
+    if name in index:
+        return index[name]
+    for name in FALLBACK_FONT_FILES:
+        if name in index:
+            print(f"Font '{font_path}' not found, using '{index[name]}'.")
+            return index[name]
+    print(f"Font '{font_path}' not found, using the default font.")
+    return None
+
+# Load a font once per process, falling back to an installed font or the default font.
+# Fonts are shared, use them under FONT_LOCK.
+@functools.lru_cache(maxsize=64)
+def get_font(font_path: str, size: int) -> Font:
+    path = resolve_font_path(font_path)
+    if path is not None:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError as e:
+            print(f"Error loading font '{path}': {e}")
+    return ImageFont.load_default(size)
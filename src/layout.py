@@ -1,103 +1,163 @@
+from dataclasses import dataclass
 from special_objects import SpecialObject
 from parameters import Parameters
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from PIL import Image, ImageDraw, ImageFont
+from drawing import draw_label, get_label_size
+from metrics import RenderMetrics, measure
+from utils import fit_image
 
 # Compute the number of grid rows needed based on columns, layout map, and total items
+# Special objects placed below the last row extend the grid so they are not cut off
 def compute_grid_rows(grid_cols: int, 
                       special_objects: list[SpecialObject], 
                       total: int) -> int:
     special_cells = sum(obj.cells() for obj in special_objects)
     normal_cells = total - sum(obj.objects() for obj in special_objects)
     total_cells = special_cells + normal_cells
-    return -(-total_cells // grid_cols) + 1  # ceil division, +1 for title
+    rows = -(-total_cells // grid_cols) + 1  # ceil division, +1 for title
+    return max([rows] + [obj.y + obj.height for obj in special_objects if obj.y > 0])
 
-# Draw the grid and place images according to the layout map
-def draw_grid(draw: ImageDraw.ImageDraw, 
-              mosaic: Image.Image, 
-              font: ImageFont.ImageFont | ImageFont.FreeTypeFont, 
-              params: Parameters, 
-              grid_rows: int, 
-              special_objects: list[SpecialObject], 
-              images: dict[int, Image.Image]):
+# Compute the slot size of every object number, the numbers of a special object share its slot
+def get_slot_sizes(params: Parameters) -> dict[int, tuple[int, int]]:
+    thumb_size = params.get_thumb_size_scaled()
+    slot_sizes = {num: (thumb_size, thumb_size) for num in params.catalog.numbers()}
+    for special in params.get_special_objects():
+        for num in special.numbers:
+            slot_sizes[num] = (special.width * thumb_size, special.height * thumb_size)
+    return slot_sizes
+
+# A slot of the grid with the objects it shows, in grid cells and in pixels
+@dataclass(frozen=True)
+class Tile:
+    numbers: tuple[int, ...]
+    col: int
+    row: int
+    col_span: int
+    row_span: int
+    x: int
+    y: int
+    width: int
+    height: int
+
+    def covers(self, col: int, row: int) -> bool:
+        return (self.col <= col < self.col + self.col_span
+                and self.row <= row < self.row + self.row_span)
+
+    # Whether the tile, border included, intersects the pixel rows [top, bottom)
+    def intersects_rows(self, top: int, bottom: int) -> bool:
+        return self.y < bottom and self.y + self.height >= top
+
+# Index the special objects by object number, a number belongs to the first special object listing it
+def build_special_index(special_objects: list[SpecialObject]) -> dict[int, SpecialObject]:
+    index: dict[int, SpecialObject] = {}
+    for special in special_objects:
+        for num in special.numbers:
+            index.setdefault(num, special)
+    return index
+
+# Compute the tiles of the grid without drawing them: large objects at their position first,
+# then the remaining objects in the first free 1x1 slot.
+# Cells are only ever marked as occupied, so the first free cell never moves backwards and
+# a cursor over an occupancy bitmap finds every slot in linear time overall.
+def compute_tiles(params: Parameters,
+                  grid_rows: int,
+                  special_objects: list[SpecialObject]) -> list[Tile]:
     thumb_size = params.get_thumb_size_scaled()
     padding = params.get_padding_scaled()
     grid_cols = params.grid_cols
+    grid_cells = grid_rows * grid_cols
+    tiles: list[Tile] = []
 
-    # Initialize occupancy grid
-    occupied = [[False] * grid_cols for _ in range(grid_rows)]
-
-    # Reserve the first row for the title
-    for c in range(grid_cols):
-        occupied[0][c] = True
-
-    # Draw overall rectangle
-    draw.rectangle([padding, padding + thumb_size, padding + grid_cols * thumb_size, padding + grid_rows * thumb_size], outline="gray", width=1)
-
-    def place_object(numbers: list[int], col: int, row: int, col_span: int = 1, row_span: int = 1):
-        """Place an image or placeholder at the given slot and mark occupied cells."""
-        slot_w = col_span * thumb_size
-        slot_h = row_span * thumb_size
-        x = col * thumb_size + padding
-        y = row * thumb_size + padding
-        name_text = ", ".join(params.catalog.prefix() + f"{num}" for num in numbers)
-
-        # Place image or placeholder
-        if any(num in images for num in numbers):
-            image = next(img for num, img in images.items() if num in numbers)
-            img = ImageOps.fit(
-                image,
-                (slot_w, slot_h),
-                Image.Resampling.LANCZOS,
-                centering=(0.5, 0.5)
-            )
-            mosaic.paste(img, (x + 1, y + 1))
+    # Occupancy bitmap in row-major order, the first row is reserved for the title
+    occupied = bytearray(grid_cells)
+    occupied[:min(grid_cols, grid_cells)] = b"\x01" * min(grid_cols, grid_cells)
 
-            # Draw the name on the image (centered at the bottom), list the names if multiple
-            bbox = draw.textbbox((0, 0), name_text, font=font)
-            tw = bbox[2] - bbox[0]
-            th = bbox[3] - bbox[1]
+    def add_tile(numbers: list[int], col: int, row: int, col_span: int = 1, row_span: int = 1):
+        tiles.append(Tile(numbers=tuple(numbers),
+                          col=col,
+                          row=row,
+                          col_span=col_span,
+                          row_span=row_span,
+                          x=col * thumb_size + padding,
+                          y=row * thumb_size + padding,
+                          width=col_span * thumb_size,
+                          height=row_span * thumb_size))
 
-            text_x = x + (slot_w - tw) // 2
-            text_y = y + slot_h - th - params.get_label_bottom_space_scaled()
-            draw.text((text_x, text_y), name_text, fill="white", font=font)
-
-        else:
-            bbox = draw.textbbox((0, 0), name_text, font=font)
-            tw = bbox[2] - bbox[0]
-            th = bbox[3] - bbox[1]
-            draw.text(
-                (x + (slot_w - tw) // 2, y + (slot_h - th) // 2),
-                name_text,
-                fill="white",
-                font=font
-            )
-
-        # Draw border
-        draw.rectangle([x, y, x + slot_w, y + slot_h], outline="gray", width=1)
-
-        # Mark cells as occupied
-        for r in range(row, row + row_span):
-            for c in range(col, col + col_span):
-                if r < grid_rows and c < grid_cols:
-                    occupied[r][c] = True
-
-    # Place large objects first
+    # Place large objects first and mark their cells as occupied.
+    # Negative positions wrap around like list indices, as the editor allows them.
     for special in special_objects:
-        place_object(special.numbers, special.x - 1, special.y, special.width, special.height)
+        col, row = special.x - 1, special.y
+        add_tile(special.numbers, col, row, special.width, special.height)
+        for r in range(max(row, -grid_rows), min(row + special.height, grid_rows)):
+            for c in range(max(col, -grid_cols), min(col + special.width, grid_cols)):
+                occupied[(r % grid_rows) * grid_cols + c % grid_cols] = 1
 
-    # Place remaining small objects
-    for i in range(params.catalog.count()):
-        num = i + 1
-        if any(num in special.numbers for special in special_objects):
+    # Place remaining small objects in the first free cell after the cursor
+    special_index = build_special_index(special_objects)
+    cursor = 0
+    for num in params.catalog.numbers():
+        if num in special_index:
             continue  # already placed
+        while cursor < grid_cells and occupied[cursor]:
+            cursor += 1
+        if cursor == grid_cells:
+            break  # grid full
+        occupied[cursor] = 1
+        add_tile([num], cursor % grid_cols, cursor // grid_cols)
+
+    return tiles
 
-        # Find first free 1x1 slot
-        placed = False
-        for r in range(grid_rows):
-            for c in range(grid_cols):
-                if not occupied[r][c]:
-                    place_object([num], c, r)
-                    placed = True
-                    break
-            if placed:
-                break
+# Draw the rectangle around the grid
+# y_offset is the top of the drawn area when only a band of the mosaic is drawn
+def draw_grid_border(draw: ImageDraw.ImageDraw, params: Parameters, grid_rows: int, y_offset: int = 0):
+    thumb_size = params.get_thumb_size_scaled()
+    padding = params.get_padding_scaled()
+    draw.rectangle([padding, padding + thumb_size - y_offset, padding + params.grid_cols * thumb_size, padding + grid_rows * thumb_size - y_offset], outline="gray", width=1)
+
+# Draw a tile with its image or a placeholder, its label and its border
+def draw_tile(draw: ImageDraw.ImageDraw,
+              mosaic: Image.Image,
+              font: ImageFont.ImageFont | ImageFont.FreeTypeFont,
+              params: Parameters,
+              tile: Tile,
+              images: dict[int, Image.Image],
+              metrics: RenderMetrics | None = None):
+    x, y = tile.x, tile.y
+    slot_w, slot_h = tile.width, tile.height
+    numbers = tile.numbers
+    name_text = ", ".join(params.catalog.prefix() + f"{num}" for num in numbers)
+
+    # Place image or placeholder
+    if any(num in images for num in numbers):
+        image = next(images[num] for num in numbers if num in images)
+        with measure(metrics, "fit"):
+            img = fit_image(image, (slot_w, slot_h), params.resampling_quality)
+        with measure(metrics, "paste"):
+            mosaic.paste(img, (x + 1, y + 1))
+
+        # Draw the name on the image (centered at the bottom), list the names if multiple
+        with measure(metrics, "text"):
+            tw, th = get_label_size(name_text, font)
+            text_x = x + (slot_w - tw) // 2
+            text_y = y + slot_h - th - params.get_label_bottom_space_scaled()
+            draw_label(mosaic, name_text, font, text_x, text_y)
+
+    else:
+        with measure(metrics, "text"):
+            tw, th = get_label_size(name_text, font)
+            draw_label(mosaic, name_text, font, x + (slot_w - tw) // 2, y + (slot_h - th) // 2)
+
+    # Draw border
+    draw.rectangle([x, y, x + slot_w, y + slot_h], outline="gray", width=1)
+
+# Draw the grid and place images according to the layout map
+def draw_grid(draw: ImageDraw.ImageDraw, 
+              mosaic: Image.Image, 
+              font: ImageFont.ImageFont | ImageFont.FreeTypeFont, 
+              params: Parameters, 
+              grid_rows: int, 
+              special_objects: list[SpecialObject], 
+              images: dict[int, Image.Image]):
+    draw_grid_border(draw, params, grid_rows)
+    for tile in compute_tiles(params, grid_rows, special_objects):
+        draw_tile(draw, mosaic, font, params, tile, images)
@@ -0,0 +1,143 @@
+import time
+from dataclasses import dataclass
+from typing import Sequence
+from special_objects import SpecialObject
+
+# Default time budget of the solver in seconds, short enough to run from the editor
+SOLVER_TIME_BUDGET = 0.5
+# Number of search nodes between two checks of the time budget
+SOLVER_CHECK_INTERVAL = 1024
+
+# Layout found by the solver
+@dataclass
+class LayoutSolution:
+    layout: list[SpecialObject]
+    rows: int       # Grid rows, title row included
+    cost: int       # Sum of the distances, in cells, between each object and its catalog order position
+    optimal: bool   # Whether the search completed, False if the time budget stopped it
+
+# Index of the cell where each special object would start if every object was laid out in
+# catalog order, counting the cells of the grid in reading order from the first row under the title
+def get_target_cells(special_objects: list[SpecialObject], numbers: Sequence[int]) -> list[int]:
+    first_numbers: dict[int, int] = {}
+    listed: set[int] = set()
+    for i, special in enumerate(special_objects):
+        listed.update(special.numbers)
+        for num in special.numbers:
+            first_numbers.setdefault(num, i)
+
+    targets = [-1] * len(special_objects)
+    cells = 0
+    for num in numbers:
+        i = first_numbers.get(num)
+        if i is not None and targets[i] < 0:
+            targets[i] = cells
+            cells += special_objects[i].cells()
+        elif num not in listed:
+            cells += 1
+    # Objects with no number of the catalog go last
+    for i, special in enumerate(special_objects):
+        if targets[i] < 0:
+            targets[i] = cells
+            cells += special.cells()
+    return targets
+
+# Branch and bound search of the positions of the special objects in a grid of the given
+# content rows (title row excluded). Rows are bitmasks of their occupied columns.
+# Returns the best (cost, positions) found and whether the search completed before the deadline.
+# Without a solution yet, the search goes on past the deadline for a greedy one only, no backtracking.
+def search_positions(sizes: list[tuple[int, int]],
+                     targets: list[int],
+                     grid_cols: int,
+                     content_rows: int,
+                     deadline: float) -> tuple[tuple[int, list[tuple[int, int]]] | None, bool]:
+    # Larger objects first, they are the hardest to fit
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][0] * sizes[i][1], targets[i]))
+
+    # Candidate positions of each object, closest to its catalog order position first
+    candidates: list[list[tuple[int, int, int, int]]] = []
+    for i in order:
+        w, h = sizes[i]
+        positions = [(abs(row * grid_cols + col - targets[i]), row, col, ((1 << w) - 1) << col)
+                     for row in range(content_rows - h + 1)
+                     for col in range(grid_cols - w + 1)]
+        positions.sort()
+        candidates.append(positions)
+
+    # Lower bound of the cost of the objects not placed yet
+    remaining_bound = [0] * (len(order) + 1)
+    for depth in range(len(order) - 1, -1, -1):
+        best_cost = candidates[depth][0][0] if candidates[depth] else 0
+        remaining_bound[depth] = remaining_bound[depth + 1] + best_cost
+
+    rows = [0] * content_rows
+    positions: list[tuple[int, int]] = [(0, 0)] * len(sizes)
+    best: tuple[int, list[tuple[int, int]]] | None = None
+    nodes = 0
+    timed_out = False
+
+    def place(depth: int, cost: int) -> bool:
+        nonlocal best, nodes, timed_out
+        if depth == len(order):
+            best = (cost, list(positions))
+            return cost == 0  # Nothing can beat a zero cost
+        i = order[depth]
+        h = sizes[i][1]
+        for position_cost, row, col, mask in candidates[depth]:
+            if best is not None and cost + position_cost + remaining_bound[depth + 1] >= best[0]:
+                break  # Candidates are sorted by cost, the next ones can't do better
+            if any(rows[r] & mask for r in range(row, row + h)):
+                continue
+            nodes += 1
+            if nodes % SOLVER_CHECK_INTERVAL == 0 and time.monotonic() > deadline:
+                timed_out = True
+            for r in range(row, row + h):
+                rows[r] |= mask
+            positions[i] = (col, row)
+            done = place(depth + 1, cost + position_cost)
+            for r in range(row, row + h):
+                rows[r] &= ~mask
+            if done or (timed_out and best is not None):
+                return True
+            if timed_out:
+                # Past the deadline without a solution, only the first fit of each object is tried
+                return False
+        return False
+
+    place(0, 0)
+    return best, not timed_out
+
+# Compute non-overlapping positions of the special objects in a grid of grid_cols columns,
+# using the fewest grid rows and keeping each object as close as possible to its position in
+# catalog order. The search stops after the time budget and returns the best layout found.
+# Raises ValueError if an object is wider than the grid.
+def solve_layout(special_objects: list[SpecialObject],
+                 grid_cols: int,
+                 numbers: Sequence[int],
+                 time_budget: float = SOLVER_TIME_BUDGET) -> LayoutSolution:
+    for special in special_objects:
+        if special.width < 1 or special.height < 1:
+            raise ValueError(f"Invalid size {special.width}x{special.height} for {special.numbers}")
+        if special.width > grid_cols:
+            raise ValueError(f"{special.numbers} is {special.width} columns wide, the grid has {grid_cols}")
+
+    deadline = time.monotonic() + time_budget
+    sizes = [(special.width, special.height) for special in special_objects]
+    targets = get_target_cells(special_objects, numbers)
+
+    # Fewest content rows holding every cell, as computed by compute_grid_rows
+    listed = {num for special in special_objects for num in special.numbers}
+    total_cells = sum(w * h for w, h in sizes) + sum(1 for num in numbers if num not in listed)
+    content_rows = max(-(-total_cells // grid_cols), max((h for _, h in sizes), default=0))
+
+    # More rows only if the objects don't fit, the first rows count that fits is the best
+    optimal = True
+    while True:
+        result, complete = search_positions(sizes, targets, grid_cols, content_rows, deadline)
+        optimal = optimal and complete
+        if result is not None:
+            cost, positions = result
+            layout = [SpecialObject(numbers=list(special.numbers), x=col + 1, y=row + 1, width=special.width, height=special.height)
+                      for special, (col, row) in zip(special_objects, positions)]
+            return LayoutSolution(layout=layout, rows=content_rows + 1, cost=cost, optimal=optimal)
+        content_rows += 1
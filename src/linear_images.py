@@ -0,0 +1,229 @@
+import os
+import zlib
+import numpy as np
+from PIL import Image
+from parameters import StretchMode
+from utils import HIGH_BIT_DEPTH_MODES, TIFF_BITS_PER_SAMPLE
+
+# Linear images: FITS files and images with more than 8 bits per channel, like the masters of
+# stacking software. They are read into NumPy arrays, binned down close to their slot size,
+# normalized to [0, 1] and stretched before being converted to 8 bits RGB.
+# Imported by utils on the first linear image only, so loading 8 bits images never imports NumPy.
+
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+FITS_DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIGURATION = 284
+TIFF_PREDICTOR = 317
+# Compressions of the strips read at full depth: none, and deflate (Adobe and the old code)
+TIFF_UNCOMPRESSED = 1
+TIFF_DEFLATE_COMPRESSIONS = (8, 32946)
+TIFF_HORIZONTAL_PREDICTOR = 2
+
+# Number of pixels sampled to compute the statistics of the stretch
+STRETCH_SAMPLES = 250_000
+# Auto stretch: the shadows are clipped at the median plus this many normalized MAD and the
+# midtones balance moves the median to the target background
+STRETCH_SHADOWS_CLIPPING = -2.8
+STRETCH_TARGET_BACKGROUND = 0.25
+# Only data with a median below this is linear and stretched. A processed picture saved with
+# 16 bits has a visible background, well above the sky of linear data.
+LINEAR_MAX_MEDIAN = 0.05
+# Asinh stretch: largest stretch factor, for very faint backgrounds
+ASINH_MAX_FACTOR = 1e6
+
+# Read the primary header of a FITS file, returns its keywords and the offset of the data
+def read_fits_header(path: str) -> tuple[dict[str, str], int]:
+    header: dict[str, str] = {}
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(FITS_BLOCK_SIZE)
+            if len(block) < FITS_BLOCK_SIZE:
+                raise ValueError("Truncated FITS header")
+            for i in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+                card = block[i:i + FITS_CARD_SIZE].decode("ascii", errors="replace")
+                keyword = card[:8].strip()
+                if keyword == "END":
+                    return header, f.tell()
+                if card[8:10] == "= ":
+                    header[keyword] = card[10:].split("/", 1)[0].strip().strip("'").strip()
+
+# Shape (height, width, channels) of the image of a FITS file
+def get_fits_shape(header: dict[str, str]) -> tuple[int, int, int]:
+    naxis = int(header.get("NAXIS", 0))
+    if naxis not in (2, 3):
+        raise ValueError(f"Unsupported FITS image with {naxis} axes")
+    channels = int(header["NAXIS3"]) if naxis == 3 else 1
+    return int(header["NAXIS2"]), int(header["NAXIS1"]), channels
+
+# Memory map the image of a FITS file as (height, width, channels), channels being 1 or 3.
+# The data is in file units, BSCALE and BZERO are applied by the caller.
+def read_fits(path: str) -> tuple[np.ndarray, dict[str, str]]:
+    header, offset = read_fits_header(path)
+    bitpix = int(header.get("BITPIX", 0))
+    if bitpix not in FITS_DTYPES:
+        raise ValueError(f"Unsupported FITS BITPIX {bitpix}")
+    height, width, channels = get_fits_shape(header)
+    data = np.memmap(path, dtype=FITS_DTYPES[bitpix], mode="r", offset=offset, shape=(channels, height, width))
+    # FITS rows go from bottom to top, color planes are stored one after the other
+    data = data[:3 if channels >= 3 else 1, ::-1].transpose(1, 2, 0)
+    return data, header
+
+# Read the samples of a 16 bits RGB TIFF file, which Pillow reduces to 8 bits. The strips may be
+# uncompressed or deflate compressed, with or without the horizontal predictor.
+# Returns None for other files, with a warning for the 16 bits RGB files it can't read.
+def read_rgb16_tiff(img: Image.Image) -> np.ndarray | None:
+    tags = getattr(img, "tag_v2", None)
+    if img.format != "TIFF" or tags is None or tuple(tags.get(TIFF_BITS_PER_SAMPLE, ())) != (16, 16, 16):
+        return None
+    compression = tags.get(TIFF_COMPRESSION, TIFF_UNCOMPRESSED)
+    predictor = tags.get(TIFF_PREDICTOR, 1)
+    if (compression not in (TIFF_UNCOMPRESSED, *TIFF_DEFLATE_COMPRESSIONS)
+            or predictor not in (1, TIFF_HORIZONTAL_PREDICTOR)
+            or tags.get(TIFF_PLANAR_CONFIGURATION, 1) != 1
+            or TIFF_STRIP_OFFSETS not in tags):
+        print(f"Warning: {os.path.basename(img.filename)} is a 16 bits TIFF with compression {compression}, "  # type: ignore[attr-defined]
+              f"loaded with 8 bits and not stretched")
+        return None
+    width, height = img.size
+    with open(img.filename, "rb") as f:  # type: ignore[attr-defined]
+        dtype = "<u2" if f.read(2) == b"II" else ">u2"
+        strips = []
+        for offset, count in zip(tags[TIFF_STRIP_OFFSETS], tags[TIFF_STRIP_BYTE_COUNTS]):
+            f.seek(offset)
+            strip = f.read(count)
+            if compression != TIFF_UNCOMPRESSED:
+                strip = zlib.decompress(strip)
+            strips.append(np.frombuffer(strip, dtype=dtype))
+    data = np.concatenate(strips)[:width * height * 3].reshape(height, width, 3)
+    if predictor == TIFF_HORIZONTAL_PREDICTOR:
+        # Each sample is stored as the difference with the previous one of the row, modulo 2^16
+        data = np.cumsum(data, axis=1, dtype=np.uint16)
+    return data
+
+# Average blocks of pixels so the image stays at least as large as the size, like a JPEG draft
+def bin_to_size(data: np.ndarray, size: tuple[int, int] | None) -> np.ndarray:
+    height, width = data.shape[:2]
+    factor = max(1, min(width // size[0], height // size[1])) if size else 1
+    if factor == 1:
+        return np.asarray(data, dtype=np.float32)
+    h, w = height // factor, width // factor
+    blocks = data[:h * factor, :w * factor].reshape(h, factor, w, factor, data.shape[2])
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+# Replace the NaN and infinite pixels, like the borders left by stacking software, by the lowest
+# finite value so they don't spread through the statistics
+def fill_non_finite(data: np.ndarray) -> np.ndarray:
+    finite = np.isfinite(data)
+    if finite.all():
+        return data
+    low = float(data[finite].min()) if finite.any() else 0.0
+    return np.where(finite, data, np.float32(low))
+
+# Pixels sampled with a regular stride to compute statistics
+def sample_pixels(data: np.ndarray) -> np.ndarray:
+    step = max(1, int((data.size / STRETCH_SAMPLES) ** 0.5))
+    return data[::step, ::step].ravel()
+
+# Whether data normalized to [0, 1] is linear, from the median of a sample of its pixels
+def is_linear(data: np.ndarray) -> bool:
+    return float(np.median(sample_pixels(data))) < LINEAR_MAX_MEDIAN
+
+# Midtones transfer function: maps 0 to 0, 1 to 1 and the midtones balance to 0.5
+def midtones_transfer(x: np.ndarray | float, midtones: float) -> np.ndarray | float:
+    return (midtones - 1) * x / ((2 * midtones - 1) * x - midtones)
+
+# Stretch data normalized to [0, 1] so its background moves to the target background, with a
+# midtones transfer function (auto) or an asinh curve. Shadows below the noise of the background
+# are clipped. Statistics are computed on a sample of the pixels and shared by the channels so
+# colors are preserved. Data that is not linear, with a median too high, is left unchanged.
+def stretch(data: np.ndarray, mode: StretchMode) -> np.ndarray:
+    if mode == StretchMode.NONE:
+        return data
+    if not is_linear(data):
+        return data
+    samples = sample_pixels(data)
+    median = float(np.median(samples))
+    mad = float(np.median(np.abs(samples - median))) * 1.4826  # Normalized MAD
+    shadows = min(max(median + STRETCH_SHADOWS_CLIPPING * mad, 0.0), median)
+    data = np.clip((data - shadows) / max(1.0 - shadows, 1e-6), 0.0, 1.0)
+    background = (median - shadows) / max(1.0 - shadows, 1e-6)
+    if background <= 0:
+        return data
+    if mode == StretchMode.ASINH:
+        factor = get_asinh_factor(background)
+        return np.arcsinh(data * factor) / np.arcsinh(factor)
+    midtones = float(midtones_transfer(background, STRETCH_TARGET_BACKGROUND))
+    return np.clip(midtones_transfer(data, midtones), 0.0, 1.0)
+
+# Factor of the asinh stretch moving the background to the target background, found by bisection
+def get_asinh_factor(background: float) -> float:
+    low, high = 1.0, ASINH_MAX_FACTOR
+    for _ in range(50):
+        factor = (low * high) ** 0.5
+        if np.arcsinh(background * factor) / np.arcsinh(factor) < STRETCH_TARGET_BACKGROUND:
+            low = factor
+        else:
+            high = factor
+    return (low * high) ** 0.5
+
+# Scale linear data to [0, 1]: integers by the range of their type, floats already in [0, 1]
+# are kept, other floats are scaled by their maximum, or their range if they have negative values
+def normalize(data: np.ndarray, max_value: float | None) -> np.ndarray:
+    if max_value is not None:
+        return data / max_value
+    low, high = float(data.min()), float(data.max())
+    if low >= 0.0 and high <= 1.0:
+        return data
+    if low >= 0.0:
+        return data / high
+    return (data - low) / max(high - low, 1e-6)
+
+def to_rgb_image(data: np.ndarray) -> Image.Image:
+    pixels = (np.clip(data, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+    if pixels.shape[2] == 1:
+        return Image.fromarray(pixels[:, :, 0], "L").convert("RGB")
+    return Image.fromarray(pixels, "RGB")
+
+# Load a FITS file as 8 bits RGB, binned close to the size if given, then stretched
+def load_fits_image(path: str, size: tuple[int, int] | None, mode: StretchMode) -> Image.Image:
+    data, header = read_fits(path)
+    binned = bin_to_size(data, size)
+    del data
+    binned = fill_non_finite(binned * float(header.get("BSCALE", 1)) + float(header.get("BZERO", 0)))
+    bitpix = int(header.get("BITPIX", 0))
+    max_value = {8: 255.0, 16: 65535.0}.get(bitpix)
+    return to_rgb_image(stretch(normalize(binned, max_value), mode))
+
+# Load an image with more than 8 bits per channel as 8 bits RGB, binned close to the size if
+# given, then stretched if linear. Returns None if Pillow decodes it as well: the image has
+# 8 bits per channel, or is a 16 bits RGB TIFF already stretched, which Pillow reduces to
+# 8 bits without changing its look.
+def load_high_bit_depth_image(img: Image.Image, size: tuple[int, int] | None, mode: StretchMode) -> Image.Image | None:
+    data: np.ndarray | None
+    rgb16_tiff = img.mode not in HIGH_BIT_DEPTH_MODES
+    if rgb16_tiff:
+        data = read_rgb16_tiff(img)
+    else:
+        data = np.asarray(img)[:, :, np.newaxis]
+    if data is None:
+        return None
+    max_value: float | None = None
+    if data.dtype.kind in "ui":
+        max_value = 65535.0 if data.dtype.itemsize == 2 or int(data.max()) <= 65535 else float(data.max())
+    normalized = normalize(fill_non_finite(bin_to_size(data, size)), max_value)
+    if rgb16_tiff and (mode == StretchMode.NONE or not is_linear(normalized)):
+        return None
+    return to_rgb_image(stretch(normalized, mode))
+
+# Decoded size in bytes of a FITS image binned to the size
+def estimate_linear_image_memory(path: str, size: tuple[int, int]) -> int:
+    header, _ = read_fits_header(path)
+    height, width, channels = get_fits_shape(header)
+    factor = max(1, min(width // size[0], height // size[1]))
+    # Binned float32 data and its 8 bits RGB conversion
+    return (height // factor) * (width // factor) * ((3 if channels >= 3 else 1) * 4 + 3)
@@ -1,21 +1,19 @@
-# Ensure Pillow is installed
-try:
-    from PIL import Image
-except ImportError:
-    import subprocess
-    import sys
-    print("Pillow not found. Installing...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "Pillow"])
-    from PIL import Image
-
 import os
+import threading
 import flet as ft
-from parameters import LayoutMode, Parameters
-from mosaic import build_mosaic, get_mosaic_dimensions
+from PIL import Image
+from parameters import ImageSelection, LayoutMode, Parameters, ResamplingQuality, StretchMode
+from mosaic import MosaicRenderer, get_mosaic_dimensions, get_preview_parameters
+from export import save_mosaic
 from catalog import Catalog
 from storage import Storage
 from special_objects_editor import open_special_objects_editor
-from utils import pil_to_base64
+from utils import PreviewEncoder, find_images, get_name_pattern
+from folder_watcher import FolderWatcher
+from render_worker import RenderWorker
+from metrics import RenderMetrics
+from render_cache import RenderCache, make_render_key
+from typing import Callable
 import copy
 
 __version__ = "2.1.0"
@@ -30,11 +28,16 @@ def main(page: ft.Page):
     # storage.clear() 
     
     params: Parameters = storage.load_parameters()
-    pil_image: Image.Image
+    pil_image: Image.Image | None = None
+    exporting = False  # Whether a save is running, one at a time
+    renderer = MosaicRenderer()
+    folder_watcher: FolderWatcher | None = None
+    preview_encoder = PreviewEncoder()
+    render_cache = RenderCache(params.get_render_cache_limit_bytes())
 
     def get_catalogs_options() -> list[ft.dropdown.Option]:
         options: list[ft.dropdown.Option] = []
-        for catalog in Catalog:
+        for catalog in Catalog.all():
             options.append(
                 ft.dropdown.Option(
                     key=catalog.id(),
@@ -54,6 +57,11 @@ def main(page: ft.Page):
         input_folder_field.value = params.input_folder
         title_field.value = params.title
         progress_switch.value = params.show_progress
+        stretch_dropdown.value = params.stretch_mode.value
+        preview_quality_dropdown.value = params.preview_quality.value
+        selection_dropdown.value = params.image_selection.value
+        preferences_field.value = params.selection_preferences
+        refresh_preferences_field()
         scale_slider.value = params.scale
         refresh_layout_controls()
         refresh_resolution_label()
@@ -78,6 +86,30 @@ def main(page: ft.Page):
         page.update()
         generate(None)
 
+    def stretch_changed(e: ft.ControlEvent):
+        params.stretch_mode = StretchMode(e.control.value)
+        generate(None)
+
+    def preview_quality_changed(e: ft.ControlEvent):
+        params.preview_quality = ResamplingQuality(e.control.value)
+        generate(None)
+
+    def selection_changed(e: ft.ControlEvent):
+        params.image_selection = ImageSelection(e.control.value)
+        refresh_preferences_field()
+        page.update()
+        generate(None)
+
+    def preferences_changed(e: ft.ControlEvent):
+        if e.control.value != params.selection_preferences:
+            params.selection_preferences = e.control.value
+            generate(None)
+
+    # The preferences are only used by the extension and tag rules
+    def refresh_preferences_field():
+        preferences_field.disabled = params.image_selection not in (ImageSelection.EXTENSION, ImageSelection.TAG)
+        preferences_field.hint_text = "tif, png" if params.image_selection == ImageSelection.EXTENSION else "final, v2"
+
     def input_folder_result(e: ft.FilePickerResultEvent):
         # Check if path is empty
         if not e.path:
@@ -90,10 +122,10 @@ def main(page: ft.Page):
     def column_changed(e: ft.ControlEvent):
         params.grid_cols = int(round(e.control.value))
         refresh_resolution_label()
-        page.update()
+        submit_render()
 
     def column_changed_ended(e: ft.ControlEvent):
-        generate(None)
+        save_parameters()
 
     def confirm_reset_dialog(e: ft.ControlEvent):
         def on_confirm(_: ft.ControlEvent):
@@ -136,6 +168,35 @@ def main(page: ft.Page):
         columns_slider.value = params.grid_cols
         page.update()
 
+    # Called on the watcher thread with the names of the files added, removed or modified.
+    # The renderer only reloads and redraws the tiles whose files changed.
+    def input_folder_changed(names: set[str]):
+        pattern = get_name_pattern(params.catalog.prefix())
+        numbers = sorted({int(match.group(1)) for name in names if (match := pattern.match(name))})
+        if numbers:
+            print(f"Input folder changed: {', '.join(params.catalog.prefix() + str(num) for num in numbers)}")
+            generate(None)
+
+    # Watch the input folder while the watch switch is on, following the folder changes
+    def refresh_folder_watcher():
+        nonlocal folder_watcher
+        folder = params.input_folder if watch_switch.value and os.path.isdir(params.input_folder) else ""
+        if folder_watcher is not None and folder_watcher.folder == folder:
+            return
+        if folder_watcher is not None:
+            folder_watcher.stop()
+            folder_watcher = None
+        if folder:
+            folder_watcher = FolderWatcher(folder, input_folder_changed)
+
+    def watch_switch_changed(_: ft.ControlEvent):
+        refresh_folder_watcher()
+
+    def stop_background_threads():
+        render_worker.stop()
+        if folder_watcher is not None:
+            folder_watcher.stop()
+
     def progress_switch_changed(e: ft.ControlEvent):
         params.show_progress = e.control.value
         page.update()
@@ -144,10 +205,10 @@ def main(page: ft.Page):
     def scale_changed(e: ft.ControlEvent):
         params.scale = e.control.value
         refresh_resolution_label()
-        page.update()
+        submit_render()
 
     def scale_change_ended(e: ft.ControlEvent):
-        generate(None)
+        save_parameters()
 
     def refresh_resolution_label():
         width, height = get_mosaic_dimensions(params)
@@ -155,27 +216,79 @@ def main(page: ft.Page):
         output_resolution_label.value = f"Output resolution: %d x %d px (%d x %d px per square)" % (width, height, thumb_size, thumb_size)
         page.update()
 
-    def generate(_: ft.ControlEvent | None):
+    # Called on the render worker thread with a snapshot of the parameters
+    def render_preview(snapshot: Parameters, is_cancelled: Callable[[], bool]) -> tuple[Image.Image, str, RenderMetrics]:
+        # Render a preview at the size of the window, the full scale is only rendered on save
+        preview_params = get_preview_parameters(snapshot, int(page.width or 1920), int(page.height or 1080))
+        metrics = RenderMetrics()
+
+        # The folder is scanned once, for the cache key and the render
+        with metrics.stage("scan"):
+            paths = find_images(preview_params.input_folder,
+                                preview_params.catalog.prefix(),
+                                preview_params.image_selection,
+                                preview_params.get_selection_preferences())
+
+        # A configuration already rendered with the same images is shown again from the cache
+        with metrics.stage("render_cache"):
+            render_cache.set_max_bytes(snapshot.get_render_cache_limit_bytes())
+            key = make_render_key(preview_params, paths)
+            cached = render_cache.get(key)
+        if cached is not None:
+            metrics.count("render_cache_hits")
+            image, src_base64 = cached
+            return image, src_base64, metrics
+
+        image = renderer.render(preview_params, is_cancelled, metrics=metrics, paths=paths)
+        with metrics.stage("preview"):
+            src_base64 = preview_encoder.encode(image)
+        # The renderer updates its canvas in place on the next render, the cache keeps a copy
+        if render_cache.max_bytes > 0:
+            with metrics.stage("render_cache"):
+                image = image.copy()
+                render_cache.put(key, image, src_base64)
+        return image, src_base64, metrics
+
+    def show_preview(result: tuple[Image.Image, str, RenderMetrics]):
         nonlocal pil_image
-        
-        buttons_row.disabled = True
-        container.controls[0] = placeholder  # loading indicator
-        page.update()
+        pil_image, src_base64, metrics = result
+        render_metrics_label.value = f"Last preview: {metrics.summary()}"
 
-        pil_image = build_mosaic(params)
-        output_image = ft.Image(src_base64=pil_to_base64(pil_image), 
+        output_image = ft.Image(src_base64=src_base64, 
                                 fit=ft.ImageFit.CONTAIN, 
                                 expand=True)
-        container.controls[0] = output_image  # put back image
-        
-        # Save parameters to client storage
-        storage.save_parameters(params)
-        storage.save_catalog(params.catalog)
+        container.controls[0] = output_image  # replace loading indicator or previous image
+        render_progress.visible = False
         buttons_row.disabled = False
         page.update()
 
+    def show_render_error(_: Exception):
+        render_progress.visible = False
+        buttons_row.disabled = False
+        page.update()
+
+    render_worker = RenderWorker(render_preview, show_preview, show_render_error)
+
+    # Render in the background, a newer request supersedes this one
+    # The sliders call it on every change and save the parameters once the change ends
+    def submit_render():
+        buttons_row.disabled = True
+        render_progress.visible = True
+        page.update()
+        render_worker.submit(params)
+
+    # Save parameters to client storage
+    def save_parameters():
+        storage.save_parameters(params)
+        storage.save_catalog(params.catalog)
+
+    def generate(_: ft.ControlEvent | None):
+        save_parameters()
+        refresh_folder_watcher()
+        submit_render()
+
     def save_image(_: ft.ControlEvent | None):
-        if pil_image:
+        if pil_image and not exporting:
             file_name = os.path.basename(params.output_file)
             initial_directory = os.path.dirname(params.output_file)
 
@@ -191,7 +304,7 @@ def main(page: ft.Page):
             # Extract folder and file name from output_file
             output_file_picker.save_file(file_name=file_name, 
                                          initial_directory=initial_directory, 
-                                         allowed_extensions=[".png", ".jpg", ".jpeg", ".tiff"])
+                                         allowed_extensions=[".png", ".jpg", ".jpeg", ".tiff", ".dzi"])
 
     def output_file_result(e: ft.FilePickerResultEvent):
         # Check if path is empty
@@ -199,19 +312,41 @@ def main(page: ft.Page):
             return
         params.output_file = e.path or ""
         storage.save_parameters(params)
-        if pil_image:
-            try:
-                pil_image.save(params.output_file)
-                success_dialog = ft.AlertDialog(title=ft.Text("Success"), 
-                                                content=ft.Text(f"Image saved successfully."), 
-                                                actions=[ft.TextButton("OK", on_click=lambda e: page.close(success_dialog))])
-                page.open(success_dialog)
-            except Exception as ex:
-                print(f"Error saving image: {ex}")
-                error_dialog = ft.AlertDialog(title=ft.Text("Error"), 
-                                               content=ft.Text(f"Failed to save image: {ex}"), 
-                                               actions=[ft.TextButton("OK", on_click=lambda e: page.close(error_dialog))])
-                page.open(error_dialog)
+        if pil_image and not exporting:
+            start_export(copy.deepcopy(params))
+
+    # Save the mosaic on a background thread so the window stays responsive, from a snapshot of
+    # the parameters so edits made meanwhile don't change the file being written
+    def start_export(snapshot: Parameters):
+        nonlocal exporting
+        exporting = True
+        save_button.disabled = True
+        export_progress.value = 0
+        export_progress.visible = True
+        page.update()
+        threading.Thread(target=export, args=(snapshot,), name="export").start()
+
+    def show_export_progress(fraction: float):
+        export_progress.value = fraction
+        page.update()
+
+    def export(snapshot: Parameters):
+        nonlocal exporting
+        try:
+            # Tile pyramids only rewrite the tiles that changed since the previous save
+            save_mosaic(snapshot, snapshot.output_file, incremental=True, on_progress=show_export_progress)
+            dialog = ft.AlertDialog(title=ft.Text("Success"), 
+                                    content=ft.Text(f"Image saved successfully."), 
+                                    actions=[ft.TextButton("OK", on_click=lambda e: page.close(dialog))])
+        except Exception as ex:
+            print(f"Error saving image: {ex}")
+            dialog = ft.AlertDialog(title=ft.Text("Error"), 
+                                    content=ft.Text(f"Failed to save image: {ex}"), 
+                                    actions=[ft.TextButton("OK", on_click=lambda e: page.close(dialog))])
+        exporting = False
+        save_button.disabled = False
+        export_progress.visible = False
+        page.open(dialog)
 
     page.title = "Astro Catalog"
     page.window.maximized = True
@@ -245,9 +380,41 @@ def main(page: ft.Page):
     edit_layout_button = ft.ElevatedButton(
                             "Edit",
                             icon=ft.Icons.EDIT,
-                            on_click=lambda _: open_special_objects_editor(page, params.layout, lambda: generate(None)))
+                            on_click=lambda _: open_special_objects_editor(page,
+                                                                          params.layout,
+                                                                          lambda: generate(None),
+                                                                          params.grid_cols,
+                                                                          params.catalog.numbers()))
     edit_layout_button.disabled = params.layout_mode == LayoutMode.BASIC
 
+    stretch_dropdown = ft.Dropdown(
+                            label="Stretch",
+                            tooltip="Stretch of FITS and 16-bit images, 8-bit images are not changed",
+                            options=[ft.dropdown.Option(key=mode.value, text=mode.value) for mode in StretchMode],
+                            value=params.stretch_mode.value,
+                            on_change=stretch_changed)
+
+    preview_quality_dropdown = ft.Dropdown(
+                            label="Preview Quality",
+                            tooltip="Resampling of the preview, saved images use the print quality by default",
+                            options=[ft.dropdown.Option(key=quality.value, text=quality.value) for quality in ResamplingQuality],
+                            value=params.preview_quality.value,
+                            on_change=preview_quality_changed)
+
+    selection_dropdown = ft.Dropdown(
+                            label="Image Selection",
+                            tooltip="Image used when several files match the same object",
+                            options=[ft.dropdown.Option(key=selection.value, text=selection.value) for selection in ImageSelection],
+                            value=params.image_selection.value,
+                            on_change=selection_changed)
+    preferences_field = ft.TextField(label="Preferred",
+                                     tooltip="Comma separated extensions or name tags, best first",
+                                     value=params.selection_preferences,
+                                     expand=True,
+                                     on_blur=preferences_changed,
+                                     on_submit=preferences_changed)
+    refresh_preferences_field()
+
     columns_slider = ft.Slider(
         value=params.grid_cols,
         min=5,
@@ -263,6 +430,12 @@ def main(page: ft.Page):
         on_change=progress_switch_changed,
     )
 
+    watch_switch = ft.Switch(
+        value=False,
+        tooltip="Update the mosaic when images are added or modified in the folder",
+        on_change=watch_switch_changed,
+    )
+
     scale_slider = ft.Slider(
         value=params.scale,
         min=1,
@@ -273,7 +446,10 @@ def main(page: ft.Page):
     )
 
     output_resolution_label = ft.Text()
+    render_metrics_label = ft.Text(style=ft.TextStyle(size=12))
     refresh_resolution_label() 
+    render_progress = ft.ProgressBar(visible=False)
+    export_progress = ft.ProgressBar(value=0, visible=False)
 
     save_button = ft.ElevatedButton(
         "Save",
@@ -322,15 +498,30 @@ def main(page: ft.Page):
                         ft.Text("Columns:"),
                         columns_slider,
                     ]),
+                    ft.Row([
+                        stretch_dropdown,
+                        preview_quality_dropdown,
+                    ]),
+                    ft.Row([
+                        selection_dropdown,
+                        preferences_field,
+                    ]),
                     ft.Row([
                         ft.Text("Show Progress:"),
                         progress_switch,
                     ]),
+                    ft.Row([
+                        ft.Text("Watch Folder:"),
+                        watch_switch,
+                    ]),
                     ft.Row([
                         ft.Text("Scale:"),
                         scale_slider,
                     ]),
                     output_resolution_label,
+                    render_metrics_label,
+                    render_progress,
+                    export_progress,
                     buttons_row
                 ], 
                 scroll=ft.ScrollMode.AUTO,
@@ -346,6 +537,12 @@ def main(page: ft.Page):
             expand=True)
     )
 
+    page.on_disconnect = lambda _: stop_background_threads()
+
     generate(None)  # Initial generation
 
-ft.app(main)
+if __name__ == "__main__":
+    # Needed by the process pool loading mode in the packed app
+    import multiprocessing
+    multiprocessing.freeze_support()
+    ft.app(main)
@@ -0,0 +1,87 @@
+import contextlib
+import time
+import tracemalloc
+from typing import Callable, ContextManager, Iterator
+
+# Context manager doing nothing, used for the stages of a render without metrics
+NO_MEASURE: ContextManager[None] = contextlib.nullcontext()
+
+# Per-stage metrics of a render: the time spent in each stage and counters like the bytes
+# decoded, the tiles fitted or the thumbnail cache hits and misses.
+# Times of the same stage add up. Stages run by the loading workers (decode, fit) add up the
+# time of every worker, so they can exceed the wall time of the load stage.
+# Memory tracing uses tracemalloc, which slows the render down and only sees the memory
+# allocated by Python, not the pixel buffers of Pillow. It is only enabled on request.
+# The optional callback is called with the name and duration of each stage when it ends,
+# e.g. to forward them to a profiler.
+class RenderMetrics:
+    def __init__(self,
+                 trace_memory: bool = False,
+                 callback: Callable[[str, float], None] | None = None):
+        self.stages: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+        self.trace_memory = trace_memory
+        self.callback = callback
+        self.peak_memory: int | None = None
+        self.started_tracing = False
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if self.callback is not None:
+            self.callback(name, seconds)
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    # Trace the memory allocated until stop_tracing, if memory tracing is enabled.
+    # Tracing already started by someone else is left running.
+    def start_tracing(self):
+        if not self.trace_memory:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        tracemalloc.reset_peak()
+
+    def stop_tracing(self):
+        if not self.trace_memory or not tracemalloc.is_tracing():
+            return
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def to_dict(self) -> dict[str, dict[str, float] | dict[str, int] | int | None]:
+        return {
+            "stages": dict(self.stages),
+            "counters": dict(self.counters),
+            "peak_memory": self.peak_memory,
+        }
+
+    # One line summary, e.g. "decode 0.52s, fit 0.10s | 12 tiles fitted, 98 cache hits, 12 misses, 45.0 MB decoded"
+    def summary(self) -> str:
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.stages.items())
+        counters: list[str] = []
+        if "render_cache_hits" in self.counters:
+            counters.append("shown from the render cache")
+        if "tiles_fitted" in self.counters:
+            counters.append(f"{self.counters['tiles_fitted']} tiles fitted")
+        if "cache_hits" in self.counters or "cache_misses" in self.counters:
+            counters.append(f"{self.counters.get('cache_hits', 0)} cache hits, {self.counters.get('cache_misses', 0)} misses")
+        if "bytes_decoded" in self.counters:
+            counters.append(f"{self.counters['bytes_decoded'] / 2 ** 20:.1f} MB decoded")
+        if self.peak_memory is not None:
+            counters.append(f"peak traced {self.peak_memory / 2 ** 20:.1f} MB")
+        return " | ".join(part for part in (stages, ", ".join(counters)) if part)
+
+# Context manager measuring a stage, doing nothing if there are no metrics
+def measure(metrics: RenderMetrics | None, name: str) -> ContextManager[None]:
+    return metrics.stage(name) if metrics is not None else NO_MEASURE
@@ -1,21 +1,18 @@
-# Ensure Pillow is installed
-try:
-    from PIL import Image, ImageDraw, ImageFont
-except ImportError:
-    import subprocess
-    import sys
-    print("Pillow not found. Installing...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "Pillow"])
-    from PIL import Image, ImageDraw, ImageFont
-
-from layout import compute_grid_rows, draw_grid
+import dataclasses
+from typing import Any, Callable, Iterator
+from PIL import Image, ImageDraw
+from layout import Tile, build_special_index, compute_grid_rows, compute_tiles, draw_grid_border, draw_tile, get_slot_sizes
 from drawing import draw_title, draw_progress
-from utils import load_images
+from fonts import Font, get_font
+from metrics import RenderMetrics, measure
+from utils import RenderCancelled, find_images, get_file_fingerprint, iter_thumbnails
+from thumbnail_cache import ThumbnailCache
 from parameters import Parameters
+from special_objects import SpecialObject
 
 def get_mosaic_dimensions(params: Parameters) -> tuple[int, int]:
-    grid_rows = compute_grid_rows(params.grid_cols, 
-                                  params.get_special_objects(), 
+    grid_rows = compute_grid_rows(params.grid_cols,
+                                  params.get_special_objects(),
                                   params.catalog.count())
     thumb_size_scaled = params.get_thumb_size_scaled()
     padding_scaled = params.get_padding_scaled()
@@ -23,49 +20,249 @@ def get_mosaic_dimensions(params: Parameters) -> tuple[int, int]:
     mosaic_h = grid_rows * thumb_size_scaled + 2 * padding_scaled
     return mosaic_w, mosaic_h
 
-# Build the mosaic image based on the provided arguments, layout map, and catalog
-def build_mosaic(params: Parameters) -> Image.Image:
-    # Load individual images
-    special_objects = params.get_special_objects()
-    images: dict[int, Image.Image] = load_images(params.input_folder, params.catalog.prefix())
+# Smallest scale of the preview, to keep the labels readable
+MIN_PREVIEW_SCALE = 0.5
+
+# Parameters rendering the mosaic at a scale fitting the given viewport, never above the export scale,
+# with the preview resampling quality.
+# Only the scale changes the layout so the preview uses the same layout computation as the export.
+def get_preview_parameters(params: Parameters, viewport_w: int, viewport_h: int) -> Parameters:
+    unit_w, unit_h = get_mosaic_dimensions(dataclasses.replace(params, scale=1.0))
+    scale = min(viewport_w / unit_w, viewport_h / unit_h, params.scale)
+    return dataclasses.replace(params, scale=max(scale, MIN_PREVIEW_SCALE), resampling_quality=params.preview_quality)
+
+# Label and title fonts, loaded once per process and falling back to an installed font if the path is invalid
+def load_fonts(params: Parameters) -> tuple[Font, Font]:
+    return get_font(params.font_path, params.get_font_size_scaled()), get_font(params.font_path, params.get_title_font_size_scaled())
+
+# Count the catalog objects that have an image, all the objects of a special slot count
+def count_images(numbers: set[int], special_objects: list[SpecialObject]) -> int:
+    special_index = build_special_index(special_objects)
+    return sum(special_index[num].objects() if num in special_index else 1 for num in numbers)
+
+# Key of what each tile draws: the fingerprints of its image files, the image options and its
+# label. A tile with the same key draws the same pixels.
+def get_tile_keys(params: Parameters, tiles: list[Tile], paths: dict[int, str]) -> dict[Tile, tuple[Any, ...]]:
+    fingerprints = {num: get_file_fingerprint(path) for num, path in paths.items()}
+    label_key = (params.catalog.prefix(), params.font_path, params.get_font_size_scaled(), params.get_label_bottom_space_scaled())
+    image_key = (params.stretch_mode, params.resampling_quality)
+    return {tile: (tuple(fingerprints.get(num) for num in tile.numbers), image_key, label_key) for tile in tiles}
+
+# Load the image of each tile and yield the tile with its images by number, in tile order:
+# the thumbnail of its first number with an image file, or nothing for a placeholder.
+# Thumbnails are loaded ahead within the memory limit of the parameters only, the caller draws
+# each tile and releases its image before the next one.
+def stream_tiles(params: Parameters,
+                 tiles: list[Tile],
+                 paths: dict[int, str],
+                 slot_sizes: dict[int, tuple[int, int]],
+                 cache: ThumbnailCache | None,
+                 is_cancelled: Callable[[], bool] | None = None,
+                 sources: dict[int, Image.Image] | None = None,
+                 metrics: RenderMetrics | None = None) -> Iterator[tuple[Tile, dict[int, Image.Image]]]:
+    tile_sources = [(tile, next((num for num in tile.numbers if num in paths and num in slot_sizes), None)) for tile in tiles]
+    thumbnails = iter_thumbnails([(num, paths[num]) for _, num in tile_sources if num is not None],
+                                 slot_sizes,
+                                 cache,
+                                 params.loading_mode,
+                                 params.get_loading_workers(),
+                                 is_cancelled,
+                                 sources,
+                                 metrics,
+                                 params.get_memory_limit_bytes(),
+                                 params.stretch_mode,
+                                 params.resampling_quality,
+                                 params.get_fit_workers())
+    for tile, source_num in tile_sources:
+        if is_cancelled is not None and is_cancelled():
+            raise RenderCancelled()
+        if source_num is None:
+            yield tile, {}
+            continue
+        num, thumbnail = next(thumbnails)
+        yield tile, {num: thumbnail} if thumbnail is not None else {}
+        del thumbnail
+    # Let the loader finish, it evicts the cache and reports
+    next(thumbnails, None)
+
+# Renders the mosaic and keeps the tiles drawn on its canvas, so that the next render only
+# redraws what changed: the title row, the progress cell or the tiles whose source file,
+# label or font size changed. Any change of the grid geometry triggers a full render.
+# The returned image is the retained canvas, it is updated in place by the next render.
+class MosaicRenderer:
+    def __init__(self):
+        self.mosaic: Image.Image | None = None
+        self.canvas_key: tuple[Any, ...] | None = None
+        self.tiles: dict[Tile, tuple[Any, ...]] = {}
+        self.title_key: tuple[str, str, int] | None = None
+        self.progress_key: str | None = None
+        self.available: set[int] = set()  # Numbers with an image drawn on the canvas
+
+    def reset(self):
+        self.__init__()
+
+    # is_cancelled is checked while loading and between tiles, the render raises RenderCancelled
+    # if it returns True. The state is only updated for what has been drawn so the next render
+    # redraws the rest. Sources are already decoded images used instead of their files.
+    # With metrics, the time of each stage and the loading counters are recorded.
+    # Paths are the images found by the caller with find_images, the folder is scanned without.
+    def render(self,
+               params: Parameters,
+               is_cancelled: Callable[[], bool] | None = None,
+               sources: dict[int, Image.Image] | None = None,
+               metrics: RenderMetrics | None = None,
+               paths: dict[int, str] | None = None) -> Image.Image:
+        if metrics is not None:
+            metrics.start_tracing()
+        try:
+            return self.render_tiles(params, is_cancelled, sources, metrics, paths)
+        finally:
+            if metrics is not None:
+                metrics.stop_tracing()
+
+    def render_tiles(self,
+                     params: Parameters,
+                     is_cancelled: Callable[[], bool] | None,
+                     sources: dict[int, Image.Image] | None,
+                     metrics: RenderMetrics | None,
+                     paths: dict[int, str] | None = None) -> Image.Image:
+        special_objects = params.get_special_objects()
+        catalog_count = params.catalog.count()
+        with measure(metrics, "layout"):
+            grid_rows = compute_grid_rows(params.grid_cols, special_objects, catalog_count)
+            mosaic_w, mosaic_h = get_mosaic_dimensions(params)
+            thumb_size_scaled = params.get_thumb_size_scaled()
+            padding_scaled = params.get_padding_scaled()
+            tiles = compute_tiles(params, grid_rows, special_objects)
+
+        # Start from a new canvas if the grid geometry changed
+        canvas_key = (mosaic_w, mosaic_h, thumb_size_scaled, padding_scaled, grid_rows)
+        if self.mosaic is None or canvas_key != self.canvas_key or set(tiles) != set(self.tiles):
+            with measure(metrics, "canvas"):
+                self.reset()
+                self.mosaic = Image.new("RGB", (mosaic_w, mosaic_h), "black")
+                self.canvas_key = canvas_key
+                self.tiles = dict.fromkeys(tiles)
+                draw_grid_border(ImageDraw.Draw(self.mosaic), params, grid_rows)
+        mosaic = self.mosaic
+        draw = ImageDraw.Draw(mosaic)
+        with measure(metrics, "fonts"):
+            font, title_font = load_fonts(params)
+
+        # Title row
+        title_key = (params.title, params.font_path, params.get_title_font_size_scaled())
+        if title_key != self.title_key:
+            with measure(metrics, "text"):
+                draw.rectangle([0, 0, mosaic_w - 1, padding_scaled + thumb_size_scaled - 1], fill="black")
+                draw_title(mosaic, params.title, title_font, mosaic_w, thumb_size_scaled, padding_scaled)
+            self.title_key = title_key
+
+        # Find the tiles whose source files, image options or label changed
+        with measure(metrics, "scan"):
+            if paths is None:
+                paths = find_images(params.input_folder, params.catalog.prefix(), params.image_selection, params.get_selection_preferences())
+            tile_keys = get_tile_keys(params, tiles, paths)
+        dirty = [tile for tile in tiles if self.tiles.get(tile) != tile_keys[tile]]
+
+        slot_sizes = get_slot_sizes(params)
+        cache = ThumbnailCache(params.input_folder) if params.input_folder else None
+
+        # Draw the changed tiles, each image is loaded, drawn and released in turn
+        def draw_tiles(tiles_to_draw: list[Tile]):
+            self.available -= {num for tile in tiles_to_draw for num in tile.numbers}
+            for tile, images in stream_tiles(params, tiles_to_draw, paths, slot_sizes, cache, is_cancelled, sources, metrics):
+                if not images:
+                    # Clear the previous image, a placeholder only draws its label
+                    draw.rectangle([tile.x + 1, tile.y + 1, tile.x + tile.width - 1, tile.y + tile.height - 1], fill="black")
+                draw_tile(draw, mosaic, font, params, tile, images, metrics)
+                if images:
+                    self.available.update(num for num in tile.numbers if num in paths)
+                self.tiles[tile] = tile_keys[tile]
 
-    # Create output image
+        draw_tiles(dirty)
+
+        # Show progress if not completed
+        progress_text: str | None = None
+        if params.show_progress:
+            images_count = count_images(self.available, special_objects)
+            if images_count < catalog_count:
+                progress_text = f"{images_count} / {catalog_count}"
+
+        # The progress cell is redrawn with the tile covering it, if any
+        progress_col, progress_row = params.grid_cols - 1, grid_rows - 1
+        progress_tile = next((tile for tile in tiles if tile.covers(progress_col, progress_row)), None)
+        progress_changed = progress_text != self.progress_key
+        if progress_changed:
+            if progress_tile is None:
+                x = progress_col * thumb_size_scaled + padding_scaled
+                y = progress_row * thumb_size_scaled + padding_scaled
+                draw.rectangle([x + 1, y + 1, x + thumb_size_scaled - 1, y + thumb_size_scaled - 1], fill="black")
+            elif progress_tile not in dirty:
+                dirty.append(progress_tile)
+                draw_tiles([progress_tile])
+
+        if progress_text is not None and (progress_changed or progress_tile in dirty):
+            with measure(metrics, "text"):
+                draw_progress(mosaic, progress_text, font, progress_col, progress_row, padding_scaled, thumb_size_scaled)
+        self.progress_key = progress_text
+
+        if metrics is not None:
+            metrics.count("tiles_drawn", len(dirty))
+        print(f"Rendered {len(dirty)} of {len(tiles)} tile(s).")
+        return mosaic
+
+# Default number of grid rows rendered at once by the band rendering
+BAND_ROWS = 2
+
+# Render the mosaic from top to bottom in horizontal bands of grid rows, with the same geometry
+# and drawing order as a full render. Only the tiles intersecting a band are loaded, so memory
+# is bounded by the band height instead of the mosaic size. The first and last bands include
+# the padding. Yields the band images in order, stacked they form the mosaic.
+def render_bands(params: Parameters,
+                 band_rows: int = BAND_ROWS,
+                 sources: dict[int, Image.Image] | None = None,
+                 metrics: RenderMetrics | None = None) -> Iterator[Image.Image]:
+    special_objects = params.get_special_objects()
     catalog_count = params.catalog.count()
     grid_rows = compute_grid_rows(params.grid_cols, special_objects, catalog_count)
     mosaic_w, mosaic_h = get_mosaic_dimensions(params)
-    mosaic = Image.new("RGB", (mosaic_w, mosaic_h), "black")
-    draw = ImageDraw.Draw(mosaic)
-
-    # Load fonts
-    font_size_scaled = params.get_font_size_scaled()
-    title_font_size_scaled = params.get_title_font_size_scaled()
-    try:
-        font = ImageFont.truetype(params.font_path, font_size_scaled)
-        title_font = ImageFont.truetype(params.font_path, title_font_size_scaled)
-    except OSError:
-        font = ImageFont.load_default(font_size_scaled)
-        title_font = ImageFont.load_default(title_font_size_scaled)
-
     thumb_size_scaled = params.get_thumb_size_scaled()
     padding_scaled = params.get_padding_scaled()
-    draw_title(draw, params.title, title_font, mosaic_w, thumb_size_scaled, padding_scaled)
-    draw_grid(draw, mosaic, font, params, grid_rows, special_objects, images)
-
-    # Show progress if not completed
-    if params.show_progress:
-        images_count = 0
-        for num in images:
-            found = False
-            for obj in special_objects:
-                if num in obj.numbers:
-                    images_count += obj.objects()
-                    found = True
-                    break
-            if not found:
-                images_count += 1
-
-        if images_count < catalog_count:
-            progress_text = f"{images_count} / {catalog_count}"
-            draw_progress(draw, progress_text, font, params.grid_cols - 1, grid_rows - 1, padding_scaled, thumb_size_scaled)
-
-    return mosaic
+    tiles = compute_tiles(params, grid_rows, special_objects)
+    font, title_font = load_fonts(params)
+    paths = find_images(params.input_folder, params.catalog.prefix(), params.image_selection, params.get_selection_preferences())
+    slot_sizes = get_slot_sizes(params)
+    cache = ThumbnailCache(params.input_folder) if params.input_folder else None
+    available: set[int] = set()
+
+    for first_row in range(0, grid_rows, max(1, band_rows)):
+        last_row = min(first_row + max(1, band_rows), grid_rows)
+        top = 0 if first_row == 0 else first_row * thumb_size_scaled + padding_scaled
+        bottom = mosaic_h if last_row == grid_rows else last_row * thumb_size_scaled + padding_scaled
+        band = Image.new("RGB", (mosaic_w, bottom - top), "black")
+        draw = ImageDraw.Draw(band)
+
+        draw_grid_border(draw, params, grid_rows, top)
+        if first_row == 0:
+            draw_title(band, params.title, title_font, mosaic_w, thumb_size_scaled, padding_scaled, top)
+
+        band_tiles = [tile for tile in tiles if tile.intersects_rows(top, bottom)]
+        for tile, images in stream_tiles(params, band_tiles, paths, slot_sizes, cache, sources=sources, metrics=metrics):
+            draw_tile(draw, band, font, params, dataclasses.replace(tile, y=tile.y - top), images, metrics)
+            if images:
+                available.update(num for num in tile.numbers if num in paths)
+
+        # The progress cell is in the last row, every tile has been loaded when it is drawn
+        if last_row == grid_rows and params.show_progress:
+            images_count = count_images(available, special_objects)
+            if images_count < catalog_count:
+                progress_text = f"{images_count} / {catalog_count}"
+                draw_progress(band, progress_text, font, params.grid_cols - 1, grid_rows - 1, padding_scaled, thumb_size_scaled, top)
+
+        yield band
+
+# Build the mosaic image based on the provided arguments, layout map, and catalog
+def build_mosaic(params: Parameters,
+                 sources: dict[int, Image.Image] | None = None,
+                 metrics: RenderMetrics | None = None) -> Image.Image:
+    return MosaicRenderer().render(params, sources=sources, metrics=metrics)
@@ -1,8 +1,8 @@
-import copy
+import os
 from enum import Enum
 import json
 from dataclasses import dataclass, field, asdict
-from catalog import Catalog
+from catalog import DEFAULT_CATALOG_ID, Catalog
 from special_objects import SpecialObject
 
 # Default parameters values who are multiplied by scale
@@ -12,43 +12,57 @@ TITLE_FONT_SIZE = 42
 PADDING = 5
 LABEL_BOTTOM_SPACE = 7
 
-# Default layouts for Messier and Caldwell catalogs
-default_messier_layout: list[SpecialObject] = [
-    SpecialObject(numbers=[8, 20],       x=3, y=2, width=2, height=3),   # Lagoon Nebula
-    SpecialObject(numbers=[16],          x=15, y=2, width=2, height=2),  # Eagle Nebula
-    SpecialObject(numbers=[31, 32, 110], x=8, y=2, width=4, height=2),   # Andromeda
-    SpecialObject(numbers=[33],          x=2, y=6, width=3, height=2),   # Triangulum Galaxy
-    SpecialObject(numbers=[42, 43],      x=7, y=5, width=2, height=3),   # Orion Nebula
-    SpecialObject(numbers=[45],          x=14, y=5, width=2, height=2),  # Pleiades
-]
-
-default_caldwell_layout: list[SpecialObject] = [
-    SpecialObject(numbers=[20], x=2, y=1, width=3, height=2),   # North America Nebula
-    SpecialObject(numbers=[33], x=12, y=2, width=2, height=3),  # Veil Nebula
-    SpecialObject(numbers=[34], x=14, y=2, width=2, height=3),  # Veil Nebula
-    SpecialObject(numbers=[68], x=8, y=2, width=2, height=2),   # Helix Nebula
-    SpecialObject(numbers=[70], x=3, y=4, width=3, height=2),   # NGC 300
-    SpecialObject(numbers=[71], x=8, y=7, width=4, height=2),   # Large Magellanic Cloud
-    SpecialObject(numbers=[72], x=1, y=7, width=3, height=2),   # Small Magellanic Cloud
-    SpecialObject(numbers=[99], x=15, y=6, width=3, height=2),  # Coalsack Nebula
-]
-
 class LayoutMode(Enum):
     BASIC = "Basic"
     ENHANCED = "Enhanced"
 
+class LoadingMode(Enum):
+    SEQUENTIAL = "Sequential"
+    THREADS = "Threads"
+    PROCESSES = "Processes"
+
+# Stretch of linear images (FITS and more than 8 bits per channel), 8 bits images are not stretched
+class StretchMode(Enum):
+    NONE = "None"
+    AUTO = "Auto"
+    ASINH = "Asinh"
+
+# Quality of the resampling of the images into their slot, from fastest to sharpest
+class ResamplingQuality(Enum):
+    DRAFT = "Draft"
+    BALANCED = "Balanced"
+    PRINT = "Print"
+
+# Rule picking the image of an object number when several files match it, ties go to the last name
+class ImageSelection(Enum):
+    NAME = "Last Name"
+    NEWEST = "Newest"
+    LARGEST = "Largest"
+    EXTENSION = "Preferred Extension"
+    TAG = "Preferred Tag"
+
 @dataclass
 class Parameters:
     input_folder: str = ""
     output_file: str = ""
     title: str = ""
-    catalog: Catalog = Catalog.MESSIER
+    catalog: Catalog = field(default_factory=Catalog.default)
     layout: list[SpecialObject] = field(default_factory=list)
     layout_mode: LayoutMode = LayoutMode.ENHANCED
     grid_cols: int = 17
     show_progress: bool = True
     scale: float = 2.0
     font_path: str = "/System/Library/Fonts/HelveticaNeue.ttc"
+    loading_mode: LoadingMode = LoadingMode.THREADS
+    loading_workers: int = 0  # 0 for one worker per CPU
+    fit_workers: int = 0  # Threads fitting images already decoded to their slots, 0 for one per CPU
+    memory_limit: int = 1024  # MB of images being loaded ahead of drawing, 0 for no limit
+    stretch_mode: StretchMode = StretchMode.AUTO
+    resampling_quality: ResamplingQuality = ResamplingQuality.PRINT  # Saved and exported mosaics
+    preview_quality: ResamplingQuality = ResamplingQuality.BALANCED  # Previews of the app
+    render_cache_limit: int = 256  # MB of previews kept in memory to show them again instantly, 0 to disable
+    image_selection: ImageSelection = ImageSelection.NAME
+    selection_preferences: str = ""  # Comma separated extensions or tags, best first, e.g. "tif, png" or "final, v2"
 
     def get_thumb_size_scaled(self) -> int:
         return int(THUMB_SIZE * self.scale)
@@ -65,40 +79,50 @@ class Parameters:
     def get_label_bottom_space_scaled(self) -> int:
         return int(LABEL_BOTTOM_SPACE * self.scale)
 
+    def get_loading_workers(self) -> int:
+        if self.loading_workers > 0:
+            return self.loading_workers
+        return os.cpu_count() or 1
+
+    def get_fit_workers(self) -> int:
+        if self.fit_workers > 0:
+            return self.fit_workers
+        return os.cpu_count() or 1
+
+    def get_memory_limit_bytes(self) -> int:
+        return max(0, self.memory_limit) * 1024 * 1024
+
+    def get_render_cache_limit_bytes(self) -> int:
+        return max(0, self.render_cache_limit) * 1024 * 1024
+
+    def get_selection_preferences(self) -> list[str]:
+        return [item.strip().lower() for item in self.selection_preferences.split(",") if item.strip()]
+
     def get_special_objects(self) -> list[SpecialObject]:
         if self.layout_mode == LayoutMode.BASIC:
             return []
         return self.layout
 
+    # Default parameters of a catalog, with its default layout
     @classmethod
-    def messier_default(cls) -> "Parameters":
-        return cls(
-            output_file="messier_catalog.png",
-            title=Catalog.MESSIER.title(),
-            layout=copy.deepcopy(default_messier_layout),
-        )
-    
-    @classmethod
-    def caldwell_default(cls) -> "Parameters":
+    def default(cls, catalog: Catalog) -> "Parameters":
         return cls(
-            output_file="caldwell_catalog.png",
-            title=Catalog.CALDWELL.title(),
-            catalog=Catalog.CALDWELL,
-            layout=copy.deepcopy(default_caldwell_layout)
+            output_file=f"{catalog.id()}_catalog.png",
+            title=catalog.title(),
+            catalog=catalog,
+            layout=catalog.default_layout(),
         )
     
-    @classmethod
-    def default(cls, catalog: Catalog) -> "Parameters":
-        if catalog == Catalog.MESSIER:
-            return cls.messier_default()
-        else:
-            return cls.caldwell_default()
-    
     def to_dict(self) -> dict[str, str | int | float | list[SpecialObject]]:
         d = asdict(self)
         d["catalog"] = self.catalog.id()
         d["layout"] = [obj.to_dict() for obj in self.layout]
         d["layout_mode"] = self.layout_mode.value
+        d["loading_mode"] = self.loading_mode.value
+        d["stretch_mode"] = self.stretch_mode.value
+        d["resampling_quality"] = self.resampling_quality.value
+        d["preview_quality"] = self.preview_quality.value
+        d["image_selection"] = self.image_selection.value
         return d
 
     @classmethod
@@ -107,7 +131,7 @@ class Parameters:
             input_folder=str(d.get("input_folder", "")),
             output_file=str(d.get("output_file", "messier_catalog.jpg")),
             title=str(d.get("title", "")),
-            catalog=Catalog.from_id(str(d.get("catalog", Catalog.MESSIER.id()))),
+            catalog=Catalog.from_id(str(d.get("catalog", DEFAULT_CATALOG_ID))),
             layout=[
                 SpecialObject.from_dict(obj) for obj in d.get("layout", []) if isinstance(obj, dict)
             ],
@@ -116,6 +140,16 @@ class Parameters:
             show_progress=bool(d.get("show_progress", True)),
             scale=float(d["scale"]) if "scale" in d and not isinstance(d["scale"], list) else 3.0,
             font_path=str(d.get("font_path", "/System/Library/Fonts/HelveticaNeue.ttc")),
+            loading_mode=LoadingMode(d.get("loading_mode", LoadingMode.THREADS.value)),
+            loading_workers=int(d["loading_workers"]) if "loading_workers" in d and not isinstance(d["loading_workers"], list) else 0,
+            fit_workers=int(d["fit_workers"]) if "fit_workers" in d and not isinstance(d["fit_workers"], list) else 0,
+            memory_limit=int(d["memory_limit"]) if "memory_limit" in d and not isinstance(d["memory_limit"], list) else 1024,
+            stretch_mode=StretchMode(d.get("stretch_mode", StretchMode.AUTO.value)),
+            resampling_quality=ResamplingQuality(d.get("resampling_quality", ResamplingQuality.PRINT.value)),
+            preview_quality=ResamplingQuality(d.get("preview_quality", ResamplingQuality.BALANCED.value)),
+            render_cache_limit=int(d["render_cache_limit"]) if "render_cache_limit" in d and not isinstance(d["render_cache_limit"], list) else 256,
+            image_selection=ImageSelection(d.get("image_selection", ImageSelection.NAME.value)),
+            selection_preferences=str(d.get("selection_preferences", "")),
         )
 
     def to_json(self) -> str:
@@ -0,0 +1,357 @@
+import hashlib
+import json
+import math
+import os
+import shutil
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+from typing import Any, Callable
+from PIL import Image
+from drawing import get_label_size
+from layout import compute_grid_rows, compute_tiles
+from metrics import RenderMetrics, measure
+from mosaic import BAND_ROWS, get_mosaic_dimensions, get_tile_keys, load_fonts, render_bands
+from parameters import Parameters
+from utils import atomic_output, find_images, get_file_fingerprint
+
+# Multi-resolution tile pyramids of the mosaic, for deep zoom viewers on the web.
+#
+# The full resolution mosaic is rendered in bands and streamed through the levels of the
+# pyramid, from the largest to the smallest: each level cuts its rows into tiles and reduces
+# them by 2 for the next level, so no level is rendered again and only a few rows of each level
+# are in memory. The tiles of all the levels are encoded and written by a thread pool as soon
+# as their rows are complete.
+#
+# A manifest of what each grid cell draws is written with the tiles, an incremental export only
+# rewrites the tiles overlapping the cells that changed since the previous export.
+
+class PyramidLayout(Enum):
+    DZI = "DZI"  # Deep Zoom: name.dzi and name_files/level/col_row.ext, level 0 is 1x1 pixel
+    XYZ = "XYZ"  # Slippy map: name/z/x/y.ext, zoom 0 is a single tile, edge tiles padded with black
+
+DZI_TILE_SIZE = 254
+DZI_OVERLAP = 1
+XYZ_TILE_SIZE = 256
+PYRAMID_TILE_FORMATS = {"jpg": "JPEG", "png": "PNG"}
+PYRAMID_JPEG_QUALITY = 90
+PYRAMID_MANIFEST = "manifest.json"
+PYRAMID_MANIFEST_VERSION = 1
+# Tiles waiting to be written per worker, bounds the memory held by the queue
+PYRAMID_QUEUE_PER_WORKER = 4
+# Margin around the cells that changed, for the antialiasing of the labels
+DIRTY_MARGIN = 2
+
+# Rectangle of pixels (left, top, right, bottom), right and bottom excluded
+Box = tuple[int, int, int, int]
+
+def get_pyramid_layout(output_file: str) -> PyramidLayout:
+    return PyramidLayout.DZI if output_file.lower().endswith(".dzi") else PyramidLayout.XYZ
+
+# Folder of the tiles: name_files next to name.dzi, or the output path without extension for XYZ
+def get_tiles_folder(output_file: str, layout: PyramidLayout) -> str:
+    base = os.path.splitext(output_file)[0]
+    return base + "_files" if layout == PyramidLayout.DZI else base
+
+# Levels of the pyramid from the full resolution to the smallest, as (level, width, height).
+# Each level is half the size of the previous one, rounded up.
+def get_pyramid_levels(width: int, height: int, layout: PyramidLayout, tile_size: int) -> list[tuple[int, int, int]]:
+    if layout == PyramidLayout.DZI:
+        count = math.ceil(math.log2(max(width, height, 1))) + 1
+    else:
+        count = max(0, math.ceil(math.log2(max(width, height, 1) / tile_size))) + 1
+    levels: list[tuple[int, int, int]] = []
+    for i in range(count):
+        levels.append((count - 1 - i, width, height))
+        width, height = (width + 1) // 2, (height + 1) // 2
+    return levels
+
+def hash_key(key: Any) -> str:
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+def stack_rows(top: Image.Image, bottom: Image.Image) -> Image.Image:
+    image = Image.new(top.mode, (top.width, top.height + bottom.height))
+    image.paste(top, (0, 0))
+    image.paste(bottom, (0, top.height))
+    return image
+
+def save_tile(image: Image.Image, path: str, image_format: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if image_format == "JPEG":
+        image.save(path, image_format, quality=PYRAMID_JPEG_QUALITY)
+    else:
+        image.save(path, image_format)
+
+# Identifies what the export draws: a canvas key for the geometry, the title and the tiling, any
+# change of which rewrites every tile, and a key per grid tile and for the progress cell.
+# Also returns the boxes of the grid tiles and the progress cell on the mosaic, labels included.
+def build_manifest(params: Parameters,
+                   layout: PyramidLayout,
+                   tile_size: int,
+                   overlap: int,
+                   tile_format: str) -> tuple[dict[str, Any], dict[str, Box]]:
+    special_objects = params.get_special_objects()
+    grid_rows = compute_grid_rows(params.grid_cols, special_objects, params.catalog.count())
+    tiles = compute_tiles(params, grid_rows, special_objects)
+    paths = find_images(params.input_folder, params.catalog.prefix(), params.image_selection, params.get_selection_preferences())
+    mosaic_w, mosaic_h = get_mosaic_dimensions(params)
+    thumb_size = params.get_thumb_size_scaled()
+    padding = params.get_padding_scaled()
+    font, _ = load_fonts(params)
+
+    canvas_key = ((mosaic_w, mosaic_h, thumb_size, padding, grid_rows),
+                  (params.title, params.font_path, params.get_title_font_size_scaled()),
+                  sorted((tile.col, tile.row, tile.col_span, tile.row_span) for tile in tiles),
+                  (layout.value, tile_size, overlap, tile_format, PYRAMID_JPEG_QUALITY))
+
+    def get_box(x: int, y: int, width: int, height: int, text: str) -> Box:
+        text_w, _ = get_label_size(text, font)
+        text_x = x + (width - text_w) // 2
+        return (min(x, text_x) - DIRTY_MARGIN, y - DIRTY_MARGIN,
+                max(x + width + 1, text_x + text_w) + DIRTY_MARGIN, y + height + 1 + DIRTY_MARGIN)
+
+    keys: dict[str, str] = {}
+    boxes: dict[str, Box] = {}
+    for tile, key in get_tile_keys(params, tiles, paths).items():
+        name = f"{tile.col},{tile.row}"
+        keys[name] = hash_key(key)
+        text = ", ".join(params.catalog.prefix() + f"{num}" for num in tile.numbers)
+        boxes[name] = get_box(tile.x, tile.y, tile.width, tile.height, text)
+
+    # The progress text depends on which images load, it changes with any image file
+    count = params.catalog.count()
+    keys["progress"] = hash_key((params.show_progress, sorted((num, get_file_fingerprint(path)) for num, path in paths.items())))
+    boxes["progress"] = get_box((params.grid_cols - 1) * thumb_size + padding, (grid_rows - 1) * thumb_size + padding,
+                                thumb_size, thumb_size, f"{count} / {count}")
+
+    manifest = {
+        "version": PYRAMID_MANIFEST_VERSION,
+        "complete": False,
+        "layout": layout.value,
+        "width": mosaic_w,
+        "height": mosaic_h,
+        "tile_size": tile_size,
+        "overlap": overlap,
+        "format": tile_format,
+        "levels": len(get_pyramid_levels(mosaic_w, mosaic_h, layout, tile_size)),
+        "canvas": hash_key(canvas_key),
+        "tiles": keys,
+    }
+    return manifest, boxes
+
+# Manifest of a complete previous export, or None
+def read_manifest(tiles_folder: str) -> dict[str, Any] | None:
+    try:
+        with open(os.path.join(tiles_folder, PYRAMID_MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != PYRAMID_MANIFEST_VERSION or not manifest.get("complete"):
+        return None
+    return manifest
+
+def write_manifest(tiles_folder: str, manifest: dict[str, Any]):
+    path = os.path.join(tiles_folder, PYRAMID_MANIFEST)
+    with atomic_output(path) as tmp_path, open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+# Remove the tiles of a previous export before a full export. Folders that were not written by
+# an export are never removed.
+def clear_tiles_folder(tiles_folder: str):
+    if not os.path.isdir(tiles_folder):
+        return
+    if os.path.exists(os.path.join(tiles_folder, PYRAMID_MANIFEST)):
+        shutil.rmtree(tiles_folder)
+    elif os.listdir(tiles_folder):
+        raise ValueError(f"'{tiles_folder}' is not empty and was not written by a tile export")
+
+def write_dzi(output_file: str, width: int, height: int, tile_size: int, overlap: int, tile_format: str):
+    with atomic_output(output_file) as tmp_file, open(tmp_file, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{tile_format}" '
+                f'Overlap="{overlap}" TileSize="{tile_size}">\n'
+                f'  <Size Width="{width}" Height="{height}"/>\n'
+                '</Image>\n')
+
+# Writes the tiles of the pyramid on a thread pool, skipping the tiles that don't overlap a
+# dirty box of the full resolution mosaic. No dirty boxes means every tile is written.
+class PyramidWriter:
+    def __init__(self,
+                 executor: ThreadPoolExecutor,
+                 workers: int,
+                 tiles_folder: str,
+                 layout: PyramidLayout,
+                 tile_size: int,
+                 overlap: int,
+                 tile_format: str,
+                 dirty_boxes: list[Box] | None):
+        self.executor = executor
+        self.max_pending = max(1, workers) * PYRAMID_QUEUE_PER_WORKER
+        self.tiles_folder = tiles_folder
+        self.layout = layout
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.tile_format = tile_format
+        self.dirty_boxes = dirty_boxes
+        self.pending: deque[Future[None]] = deque()
+        self.written = 0
+        self.skipped = 0
+
+    def get_tile_path(self, level: int, col: int, row: int) -> str:
+        if self.layout == PyramidLayout.DZI:
+            return os.path.join(self.tiles_folder, str(level), f"{col}_{row}.{self.tile_format}")
+        return os.path.join(self.tiles_folder, str(level), str(col), f"{row}.{self.tile_format}")
+
+    def is_dirty(self, box: Box) -> bool:
+        if self.dirty_boxes is None:
+            return True
+        left, top, right, bottom = box
+        return any(left < r and l < right and top < b and t < bottom for l, t, r, b in self.dirty_boxes)
+
+    # Write the tile cut from the rows at the given box, base_box is the same box at full resolution
+    def write_tile(self, level: int, col: int, row: int, rows: Image.Image, box: Box, base_box: Box):
+        if not self.is_dirty(base_box):
+            self.skipped += 1
+            return
+        tile = rows.crop(box)
+        if self.layout == PyramidLayout.XYZ and tile.size != (self.tile_size, self.tile_size):
+            padded = Image.new("RGB", (self.tile_size, self.tile_size), "black")
+            padded.paste(tile, (0, 0))
+            tile = padded
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(save_tile, tile, self.get_tile_path(level, col, row),
+                                                 PYRAMID_TILE_FORMATS[self.tile_format]))
+        self.written += 1
+
+    # Wait for the tiles being written, raises the first error
+    def flush(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+# A level of the pyramid receiving its rows from top to bottom. It keeps the rows of its current
+# row of tiles, overlap included, and passes its rows reduced by 2 to the next smaller level.
+class PyramidLevel:
+    def __init__(self,
+                 writer: PyramidWriter,
+                 level: int,
+                 width: int,
+                 height: int,
+                 scale: int,
+                 smaller: "PyramidLevel | None"):
+        self.writer = writer
+        self.level = level
+        self.width = width
+        self.height = height
+        self.scale = scale  # Full resolution pixels per pixel of this level
+        self.smaller = smaller
+        self.rows: Image.Image | None = None
+        self.rows_top = 0
+        self.received = 0
+        self.tile_row = 0
+        self.odd_row: Image.Image | None = None  # Row waiting for its pair to be reduced
+
+    def add_rows(self, rows: Image.Image):
+        self.received += rows.height
+        self.rows = rows if self.rows is None else stack_rows(self.rows, rows)
+        self.write_tile_rows()
+        if self.smaller is not None:
+            self.reduce_rows(rows)
+
+    def write_tile_rows(self):
+        tile_size, overlap = self.writer.tile_size, self.writer.overlap
+        while self.rows is not None:
+            top = max(self.tile_row * tile_size - overlap, 0)
+            bottom = min((self.tile_row + 1) * tile_size + overlap, self.height)
+            if self.received < bottom:
+                return
+            for col in range(-(-self.width // tile_size)):
+                left = max(col * tile_size - overlap, 0)
+                right = min((col + 1) * tile_size + overlap, self.width)
+                box = (left, top - self.rows_top, right, bottom - self.rows_top)
+                base_box = (left * self.scale, top * self.scale, right * self.scale, bottom * self.scale)
+                self.writer.write_tile(self.level, col, self.tile_row, self.rows, box, base_box)
+            self.tile_row += 1
+            if self.tile_row * tile_size >= self.height:
+                self.rows = None
+                return
+            # Keep the rows of the next row of tiles only
+            drop = self.tile_row * tile_size - overlap - self.rows_top
+            if drop > 0:
+                self.rows = self.rows.crop((0, drop, self.width, self.rows.height))
+                self.rows_top += drop
+
+    # Image.reduce averages blocks of 2x2 pixels aligned on the top left corner, the rows are
+    # passed in pairs so the smaller level is the same as reducing the whole level at once
+    def reduce_rows(self, rows: Image.Image):
+        assert self.smaller is not None
+        if self.odd_row is not None:
+            rows = stack_rows(self.odd_row, rows)
+            self.odd_row = None
+        if self.received < self.height and rows.height % 2:
+            self.odd_row = rows.crop((0, rows.height - 1, self.width, rows.height))
+            rows = rows.crop((0, 0, self.width, rows.height - 1))
+        if rows.height:
+            self.smaller.add_rows(rows.reduce(2))
+
+# Export the mosaic at full scale as a tile pyramid: DZI if the output file ends with .dzi, else
+# XYZ tiles in the folder named like the output file without its extension.
+# An incremental export only rewrites the tiles overlapping the grid cells that changed since the
+# previous export to the same place, a full export replaces the previous tiles.
+# Returns the number of tiles written.
+def export_pyramid(params: Parameters,
+                   output_file: str,
+                   layout: PyramidLayout | None = None,
+                   tile_format: str = "jpg",
+                   incremental: bool = False,
+                   workers: int = 0,
+                   band_rows: int = BAND_ROWS,
+                   sources: dict[int, Image.Image] | None = None,
+                   metrics: RenderMetrics | None = None,
+                   on_progress: Callable[[float], None] | None = None) -> int:
+    if tile_format not in PYRAMID_TILE_FORMATS:
+        raise ValueError(f"Unsupported tile format '{tile_format}'")
+    layout = layout or get_pyramid_layout(output_file)
+    tiles_folder = get_tiles_folder(output_file, layout)
+    tile_size, overlap = (DZI_TILE_SIZE, DZI_OVERLAP) if layout == PyramidLayout.DZI else (XYZ_TILE_SIZE, 0)
+
+    with measure(metrics, "scan"):
+        manifest, boxes = build_manifest(params, layout, tile_size, overlap, tile_format)
+        previous = read_manifest(tiles_folder) if incremental else None
+        dirty_boxes: list[Box] | None = None
+        if previous is not None and previous.get("canvas") == manifest["canvas"]:
+            dirty_boxes = [box for name, box in boxes.items() if previous["tiles"].get(name) != manifest["tiles"][name]]
+            if not dirty_boxes:
+                print(f"Tile pyramid {tiles_folder} is up to date.")
+                return 0
+        else:
+            clear_tiles_folder(tiles_folder)
+
+    # The manifest is marked complete once every tile is written, an interrupted export is redone in full
+    os.makedirs(tiles_folder, exist_ok=True)
+    write_manifest(tiles_folder, manifest)
+
+    width, height = manifest["width"], manifest["height"]
+    levels = get_pyramid_levels(width, height, layout, tile_size)
+    workers = workers if workers > 0 else os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        writer = PyramidWriter(executor, workers, tiles_folder, layout, tile_size, overlap, tile_format, dirty_boxes)
+        # Chain the levels from the smallest, the last one is the full resolution
+        base: PyramidLevel | None = None
+        for i, (level, level_w, level_h) in reversed(list(enumerate(levels))):
+            base = PyramidLevel(writer, level, level_w, level_h, 2 ** i, base)
+        assert base is not None
+        for band in render_bands(params, band_rows, sources, metrics):
+            with measure(metrics, "encode"):
+                base.add_rows(band)
+            if on_progress is not None:
+                on_progress(base.received / height)
+        with measure(metrics, "encode"):
+            writer.flush()
+
+    if layout == PyramidLayout.DZI:
+        write_dzi(output_file, width, height, tile_size, overlap, tile_format)
+    manifest["complete"] = True
+    write_manifest(tiles_folder, manifest)
+    print(f"Wrote {writer.written} of {writer.written + writer.skipped} tile(s) in {len(levels)} level(s) to {tiles_folder}.")
+    return writer.written
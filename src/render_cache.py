@@ -0,0 +1,70 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any
+from PIL import Image
+from parameters import Parameters
+from utils import find_images, get_file_fingerprint
+
+# Parameters that don't change the rendered image
+RENDER_KEY_IGNORED = ("output_file", "loading_mode", "loading_workers", "fit_workers", "memory_limit", "render_cache_limit")
+
+# Fingerprint of the images of the catalog in the input folder: the number, path, size and
+# modification time of each, in number order. The paths found by the caller avoid another scan.
+def get_folder_fingerprint(params: Parameters, paths: dict[int, str] | None = None) -> list[tuple[int, tuple[str, int, int] | None]]:
+    if paths is None:
+        paths = find_images(params.input_folder, params.catalog.prefix(), params.image_selection, params.get_selection_preferences())
+    return [(num, get_file_fingerprint(paths[num])) for num in sorted(paths)]
+
+# Key of the render of the parameters: a hash of their canonical JSON, keys sorted and the
+# parameters that don't change the image left out, and of the fingerprint of the input folder
+def make_render_key(params: Parameters, paths: dict[int, str] | None = None) -> str:
+    d = {name: value for name, value in params.to_dict().items() if name not in RENDER_KEY_IGNORED}
+    canonical = json.dumps([d, get_folder_fingerprint(params, paths)], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# In-memory cache of rendered images and their encoded preview, keyed by make_render_key, so a
+# configuration seen before is shown again without rendering. Entries are evicted least recently
+# used first once over the byte budget, entries larger than the budget are not kept.
+# Images must not be modified once cached.
+class RenderCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, tuple[Image.Image, Any, int]] = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[Image.Image, Any] | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def put(self, key: str, image: Image.Image, encoded: Any = None):
+        size = image.width * image.height * len(image.getbands()) + (len(encoded) if isinstance(encoded, (str, bytes)) else 0)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[2]
+            if size <= self.max_bytes:
+                self.entries[key] = (image, encoded, size)
+                self.bytes += size
+            self.evict()
+
+    # Evict the least recently used entries until the cache fits its budget, call with the lock
+    def evict(self):
+        while self.entries and self.bytes > self.max_bytes:
+            _, (_, _, size) = self.entries.popitem(last=False)
+            self.bytes -= size
+
+    def set_max_bytes(self, max_bytes: int):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
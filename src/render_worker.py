@@ -0,0 +1,83 @@
+import copy
+import threading
+import time
+from typing import Callable, Generic, TypeVar
+from parameters import Parameters
+from utils import RenderCancelled
+
+# Delay without new request before a render starts, so bursts of slider events render once
+RENDER_DEBOUNCE = 0.15
+
+T = TypeVar("T")
+
+# Runs renders on a background thread so the UI stays responsive.
+# Each request takes a snapshot of the parameters. Requests arriving within the debounce delay
+# are coalesced, a render superseded by a newer request is cancelled, and only the result of
+# the latest request is published. Callbacks are called from the worker thread.
+class RenderWorker(Generic[T]):
+    def __init__(self,
+                 render: Callable[[Parameters, Callable[[], bool]], T],
+                 on_result: Callable[[T], None],
+                 on_error: Callable[[Exception], None] | None = None,
+                 debounce: float = RENDER_DEBOUNCE):
+        self.render = render
+        self.on_result = on_result
+        self.on_error = on_error
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        self.pending: Parameters | None = None
+        self.generation = 0
+        self.last_request = 0.0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="render-worker", daemon=True)
+        self.thread.start()
+
+    def submit(self, params: Parameters):
+        snapshot = copy.deepcopy(params)
+        with self.condition:
+            self.pending = snapshot
+            self.generation += 1
+            self.last_request = time.monotonic()
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def is_superseded(self, generation: int) -> bool:
+        return self.stopped or self.generation != generation
+
+    def next_request(self) -> tuple[Parameters, int] | None:
+        with self.condition:
+            while self.pending is None and not self.stopped:
+                self.condition.wait()
+            # Wait until no new request came during the debounce delay
+            while not self.stopped:
+                remaining = self.last_request + self.debounce - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            if self.stopped or self.pending is None:
+                return None
+            params, self.pending = self.pending, None
+            return params, self.generation
+
+    def run(self):
+        while True:
+            request = self.next_request()
+            if request is None:
+                return
+            params, generation = request
+            try:
+                result = self.render(params, lambda: self.is_superseded(generation))
+            except RenderCancelled:
+                print("Render cancelled by a newer request.")
+                continue
+            except Exception as e:
+                print(f"Error rendering mosaic: {e}")
+                if self.on_error is not None and not self.is_superseded(generation):
+                    self.on_error(e)
+                continue
+            if not self.is_superseded(generation):
+                self.on_result(result)
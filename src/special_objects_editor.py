@@ -1,11 +1,17 @@
 import copy
 import flet as ft
-from typing import Callable
+from typing import Callable, Sequence
+from layout_solver import solve_layout
 from special_objects import SpecialObject
 
 FIELD_WIDTH = 100
 
-def open_special_objects_editor(page: ft.Page, data: list[SpecialObject], on_apply: Callable[[], None]):
+# grid_cols and numbers are the columns of the grid and the numbers of the catalog, used by the automatic layout
+def open_special_objects_editor(page: ft.Page,
+                                data: list[SpecialObject],
+                                on_apply: Callable[[], None],
+                                grid_cols: int,
+                                numbers: Sequence[int]):
     # Make a deep copy of data so Cancel doesn't affect original
     data_copy = copy.deepcopy(data)
 
@@ -56,11 +62,9 @@ def open_special_objects_editor(page: ft.Page, data: list[SpecialObject], on_app
         editor_col.controls.insert(len(editor_col.controls) - 1, new_row)
         page.update()
 
-    # Apply all changes
-    def apply_changes(_: ft.ControlEvent):
-        nonlocal data
-        new_data: list[SpecialObject] = []
-
+    # Read the objects of the rows with their fields
+    def read_rows() -> list[tuple[SpecialObject, dict[str, ft.TextField]]]:
+        objects: list[tuple[SpecialObject, dict[str, ft.TextField]]] = []
         for ref in fields_refs:
             # Skip completely empty rows
             if not any((ref[f].value or "").strip() for f in ref):
@@ -73,10 +77,31 @@ def open_special_objects_editor(page: ft.Page, data: list[SpecialObject], on_app
                     width=int(ref["width"].value or 1),
                     height=int(ref["height"].value or 1),
                 )
-                new_data.append(new_obj)
+                objects.append((new_obj, ref))
             except ValueError:
                 # Ignore invalid rows silently (could show an alert instead)
                 pass
+        return objects
+
+    # Compute the positions of the objects from their sizes and fill the Column and Row fields
+    def auto_layout(_: ft.ControlEvent):
+        objects = read_rows()
+        try:
+            solution = solve_layout([obj for obj, _ in objects], grid_cols, numbers)
+        except ValueError as e:
+            solver_status.value = str(e)
+            page.update()
+            return
+        for solved, (_, ref) in zip(solution.layout, objects):
+            ref["x"].value = str(solved.x)
+            ref["y"].value = str(solved.y)
+        solver_status.value = f"{solution.rows} rows with {grid_cols} columns" + ("" if solution.optimal else " (best found in time)")
+        page.update()
+
+    # Apply all changes
+    def apply_changes(_: ft.ControlEvent):
+        nonlocal data
+        new_data = [obj for obj, _ in read_rows()]
 
         # Replace the original list contents
         data.clear()
@@ -94,6 +119,7 @@ def open_special_objects_editor(page: ft.Page, data: list[SpecialObject], on_app
 
     # Build UI
     editor_col = ft.Column(scroll=ft.ScrollMode.AUTO, expand=True)
+    solver_status = ft.Text(style=ft.TextStyle(size=12))
 
     # Add existing rows
     # Sort objects by the first number in their 'numbers' list; objects with empty 'numbers' are sorted last due to float('inf')
@@ -105,7 +131,13 @@ def open_special_objects_editor(page: ft.Page, data: list[SpecialObject], on_app
     # Add button bar
     button_row = ft.Row(
         [
-            ft.ElevatedButton("Add Row", on_click=add_new_row),
+            ft.Row(
+                [
+                    ft.ElevatedButton("Add Row", on_click=add_new_row),
+                    ft.ElevatedButton("Auto Layout", icon=ft.Icons.AUTO_FIX_HIGH, on_click=auto_layout),
+                    solver_status,
+                ]
+            ),
             ft.Row(
                 [
                     ft.TextButton("Cancel", on_click=cancel_changes),
@@ -1,11 +1,15 @@
-from flet import Page
+from typing import TYPE_CHECKING
 from catalog import Catalog
 from parameters import Parameters
 
+# Only the type of the page comes from Flet, the rendering core imports this module without it
+if TYPE_CHECKING:
+    from flet import Page
+
 CATALOG_SELECTED_KEY = "astro_catalog_selected"
 
 class Storage:
-    def __init__(self, page: Page):
+    def __init__(self, page: "Page"):
         self.page = page
 
     def save_parameters(self, params: Parameters):
@@ -31,7 +35,7 @@ class Storage:
             id = self.page.client_storage.get(CATALOG_SELECTED_KEY)
             if isinstance(id, str):
                 return Catalog.from_id(id)
-        return Catalog.MESSIER  # Default to MESSIER if not found
+        return Catalog.default()  # Default to Messier if not found
 
     def clear(self):
         self.page.client_storage.clear() 
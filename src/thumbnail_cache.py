@@ -0,0 +1,86 @@
+import hashlib
+import os
+import sys
+from PIL import Image
+
+# Default size budget of the thumbnails cache of one input folder
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_FILE_EXTENSION = ".png"
+
+# Return the per-user cache directory of the app, following each OS convention
+# ASTRO_CATALOG_CACHE_DIR overrides it, e.g. to benchmark with a cold cache
+def get_user_cache_dir() -> str:
+    if os.environ.get("ASTRO_CATALOG_CACHE_DIR"):
+        return os.environ["ASTRO_CATALOG_CACHE_DIR"]
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~\\AppData\\Local")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "astro-catalog")
+
+# On-disk cache of images already fitted to their slot, one directory per input folder.
+# Entries are keyed by the source file fingerprint (path, size, mtime), the slot size and
+# the resampling and decoding options, and are evicted least recently used first once over the size budget.
+class ThumbnailCache:
+    def __init__(self, input_folder: str, cache_dir: str | None = None, max_bytes: int = CACHE_MAX_BYTES):
+        folder_key = hashlib.sha1(os.path.abspath(input_folder).encode("utf-8")).hexdigest()[:16]
+        self.directory = os.path.join(cache_dir or get_user_cache_dir(), "thumbnails", folder_key)
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(path: str, size: tuple[int, int], options: str) -> str | None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        fingerprint = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{size[0]}x{size[1]}|{options}"
+        return hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()
+
+    def get_file(self, key: str) -> str:
+        return os.path.join(self.directory, key + CACHE_FILE_EXTENSION)
+
+    def get(self, key: str) -> Image.Image | None:
+        file = self.get_file(key)
+        try:
+            with Image.open(file) as img:
+                tile = img.convert("RGB")
+            # Refresh the modification time, used as last access time for the LRU eviction
+            os.utime(file)
+        except (OSError, ValueError):
+            return None
+        return tile
+
+    def put(self, key: str, tile: Image.Image):
+        file = self.get_file(key)
+        tmp_file = f"{file}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tile.save(tmp_file, format="PNG", compress_level=1)
+            os.replace(tmp_file, file)
+        except OSError as e:
+            print(f"Error writing thumbnail cache {file}: {e}")
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    # Remove the least recently used entries until the cache fits in its size budget
+    def evict(self):
+        stats: list[tuple[int, int, str]] = []
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith(CACHE_FILE_EXTENSION):
+                    stat = entry.stat()
+                    stats.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in stats)
+        for _, size, path in sorted(stats):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError as e:
+                print(f"Error evicting thumbnail cache {path}: {e}")
+
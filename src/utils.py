@@ -1,34 +1,490 @@
+import contextlib
+import functools
+import hashlib
 import os
 import re
-from PIL import Image
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterator, TypeVar
+from collections import deque
+from dataclasses import dataclass, replace
+from PIL import Image, ImageMode, ImageOps, features
 import io, base64
+from metrics import RenderMetrics, measure
+from parameters import ImageSelection, LoadingMode, ResamplingQuality, StretchMode
+from thumbnail_cache import ThumbnailCache
 
-# Load images from the input folder with a name that starts with 'prefix' and followed by a number
-# Returns a dictionary mapping the number to the Image object
-def load_images(input_folder: str, prefix: str) -> dict[int, Image.Image]:
+# Resampling of each quality to fit the images into their slot: the final filter and the
+# reducing gap. Images more than gap times larger than their slot are first reduced by an integer
+# factor with Image.reduce, a cheap box filter, to about gap times the slot size, then resampled
+# with the filter. No gap resamples the full image with the filter.
+FIT_RESAMPLING: dict[ResamplingQuality, tuple[Image.Resampling, float | None]] = {
+    ResamplingQuality.DRAFT: (Image.Resampling.BILINEAR, 1.0),
+    ResamplingQuality.BALANCED: (Image.Resampling.LANCZOS, 2.0),
+    ResamplingQuality.PRINT: (Image.Resampling.LANCZOS, None),
+}
+
+# Linear images, see linear_images. That module imports NumPy, it is only imported when one is loaded.
+FITS_EXTENSIONS = (".fit", ".fits", ".fts")
+# Pillow modes with more than 8 bits per channel
+HIGH_BIT_DEPTH_MODES = {"I", "F", "I;16", "I;16B", "I;16L", "I;16N"}
+TIFF_BITS_PER_SAMPLE = 258
+
+# Default encoding of the preview sent to Flet
+PREVIEW_FORMAT = "JPEG"
+PREVIEW_QUALITY = 90
+PREVIEW_PNG_COMPRESS_LEVEL = 1
+
+# Compile the pattern matching the image names of a catalog prefix, like M31, NGC_7000 or Sh2-155.
+# The prefix is matched literally and the pattern is anchored with no nested repetition,
+# so matching stays linear on large folders.
+@functools.lru_cache(maxsize=None)
+def get_name_pattern(prefix: str) -> re.Pattern[str]:
+    return re.compile(re.escape(prefix) + r"[ _-]?(\d+)")
+
+# A file of the input folder matching an object number, with its header if it was read
+@dataclass(frozen=True)
+class ImageCandidate:
+    path: str
+    tag: str  # Rest of the name after the number without the extension, "final" for M31_final.tif
+    file_size: int
+    mtime_ns: int
+    header: tuple[int, int, str, int] | None = None  # Width, height, mode and bits per channel
+
+# Read the width, height, mode and bits per channel of an image from its header, without
+# decoding it. Returns None if the file is not an image. Cached by path, size and modification
+# time, so scanning the folder again only reads the headers of the files that changed.
+@functools.lru_cache(maxsize=4096)
+def read_image_header(path: str, file_size: int, mtime_ns: int) -> tuple[int, int, str, int] | None:
+    try:
+        if is_fits_file(path):
+            from linear_images import get_fits_shape, read_fits_header
+            header, _ = read_fits_header(path)
+            height, width, channels = get_fits_shape(header)
+            return width, height, "RGB" if channels >= 3 else "L", abs(int(header.get("BITPIX", 0)))
+        with Image.open(path) as img:
+            bits = 8
+            if img.mode in ("I", "F"):
+                bits = 32
+            elif is_high_bit_depth_image(img):
+                bits = 16
+            return img.width, img.height, img.mode, bits
+    except (OSError, ValueError, KeyError, SyntaxError):
+        return None
+
+# Index the files of the input folder with a name that starts with 'prefix' followed by a number.
+# Returns the candidates of each number in name order. Headers are only read for the numbers with
+# several candidates, the files that are not images are dropped from them.
+def scan_images(input_folder: str, prefix: str) -> dict[int, list[ImageCandidate]]:
     if not input_folder or not os.path.isdir(input_folder):
         print(f"Error: '{input_folder}' is not a valid directory.")
         return {}
 
-    pattern = re.compile(prefix + r"[ _-]?(\d+)")
-    images: dict[int, Image.Image] = {}
-    for fname in os.listdir(input_folder):
+    pattern = get_name_pattern(prefix)
+    candidates: dict[int, list[ImageCandidate]] = {}
+    for fname in sorted(os.listdir(input_folder)):
         match = pattern.match(fname)
         if not match:
             continue
-        num = int(match.group(1))
         path = os.path.join(input_folder, fname)
         try:
-            img = Image.open(path).convert("RGB")
-            images[num] = img
-        except Exception as e:
-            print(f"Error loading {fname}: {e}")
+            stat = os.stat(path)
+        except OSError:
+            continue  # Removed while scanning
+        tag = os.path.splitext(fname)[0][match.end():].strip(" _-.").lower()
+        candidates.setdefault(int(match.group(1)), []).append(ImageCandidate(path, tag, stat.st_size, stat.st_mtime_ns))
+
+    for num, files in candidates.items():
+        if len(files) > 1:
+            with_headers = [replace(file, header=read_image_header(file.path, file.file_size, file.mtime_ns)) for file in files]
+            candidates[num] = [file for file in with_headers if file.header is not None] or files
+    return candidates
+
+# Pick the candidate of a number with the selection rule. Preferences are the extensions or tags
+# of the rule, best first, candidates without one rank last. Ties go to the last name.
+def select_image(candidates: list[ImageCandidate],
+                 selection: ImageSelection = ImageSelection.NAME,
+                 preferences: list[str] | tuple[str, ...] = ()) -> ImageCandidate:
+    def rank(value: str) -> int:
+        return -preferences.index(value) if value in preferences else -len(preferences)
+
+    def key(candidate: ImageCandidate) -> tuple[Any, ...]:
+        name = os.path.basename(candidate.path)
+        if selection == ImageSelection.NEWEST:
+            return candidate.mtime_ns, name
+        if selection == ImageSelection.LARGEST:
+            width, height, _, bits = candidate.header or (0, 0, "", 0)
+            return width * height, bits, name
+        if selection == ImageSelection.EXTENSION:
+            return rank(os.path.splitext(name)[1].lstrip(".").lower()), name
+        if selection == ImageSelection.TAG:
+            return rank(candidate.tag), name
+        return (name,)
+
+    return max(candidates, key=key)
+
+# Find the images in the input folder with a name that starts with 'prefix' and followed by a number
+# Returns a dictionary mapping the number to the image path
+# When several files map to the same number, the selection rule picks one, see select_image.
+# Only the headers of the candidates are read, the winners are decoded by the caller.
+def find_images(input_folder: str,
+                prefix: str,
+                selection: ImageSelection = ImageSelection.NAME,
+                preferences: list[str] | tuple[str, ...] = ()) -> dict[int, str]:
+    preferences = [item.lstrip(".") for item in preferences] if selection == ImageSelection.EXTENSION else preferences
+    return {num: select_image(files, selection, preferences).path
+            for num, files in scan_images(input_folder, prefix).items()}
+
+# Identify the content of a file by its path, size and modification time without reading it
+# Returns None if the file doesn't exist anymore
+def get_file_fingerprint(path: str) -> tuple[str, int, int] | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def is_fits_file(path: str) -> bool:
+    return path.lower().endswith(FITS_EXTENSIONS)
+
+# Whether the image has more than 8 bits per channel, 16 bits RGB TIFF files included which
+# Pillow opens as 8 bits RGB
+def is_high_bit_depth_image(img: Image.Image) -> bool:
+    if img.mode in HIGH_BIT_DEPTH_MODES:
+        return True
+    tags = getattr(img, "tag_v2", None)
+    return img.format == "TIFF" and tags is not None and tuple(tags.get(TIFF_BITS_PER_SAMPLE, ())) == (16, 16, 16)
+
+# Write a file atomically: yields a temporary path next to the file, renamed over the file if the
+# block succeeds and removed otherwise, so the file is never seen partially written
+@contextlib.contextmanager
+def atomic_output(path: str) -> Iterator[str]:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Open an image file and decode it as RGB
+# If a size is given, JPEG files are decoded at the smallest DCT scale (1/2, 1/4 or 1/8)
+# that still covers it, which is much faster and lighter than a full resolution decode.
+# FITS files and images with more than 8 bits per channel are binned close to the size and
+# stretched, see linear_images.
+def load_image(path: str, size: tuple[int, int] | None = None, stretch: StretchMode = StretchMode.AUTO) -> Image.Image:
+    if is_fits_file(path):
+        from linear_images import load_fits_image
+        return load_fits_image(path, size, stretch)
+    with Image.open(path) as img:
+        if is_high_bit_depth_image(img):
+            from linear_images import load_high_bit_depth_image
+            image = load_high_bit_depth_image(img, size, stretch)
+            if image is not None:
+                return image
+        if size is not None and img.format == "JPEG":
+            img.draft("RGB", size)
+        return img.convert("RGB")
+
+# Crop and resize an image to fill the given size, keeping it centered, like ImageOps.fit
+def fit_image(image: Image.Image,
+              size: tuple[int, int],
+              quality: ResamplingQuality = ResamplingQuality.PRINT) -> Image.Image:
+    if image.size == size:
+        return image
+    resample, reducing_gap = FIT_RESAMPLING[quality]
+    if reducing_gap is None:
+        return ImageOps.fit(image, size, resample, centering=(0.5, 0.5))
+    # Centered crop box with the aspect ratio of the size
+    width, height = image.size
+    if width * size[1] > height * size[0]:
+        crop_w, crop_h = size[0] * height / size[1], float(height)
+    else:
+        crop_w, crop_h = float(width), size[1] * width / size[0]
+    left, top = (width - crop_w) / 2, (height - crop_h) / 2
+    return image.resize(size, resample, box=(left, top, left + crop_w, top + crop_h), reducing_gap=reducing_gap)
+
+# A thumbnail loaded by load_thumbnail, whether it came from the cache, the time spent in the
+# cache, decoding and fitting, and the bytes decoded
+@dataclass
+class LoadedThumbnail:
+    tile: Image.Image
+    cached: bool
+    cache_time: float = 0.0
+    decode_time: float = 0.0
+    fit_time: float = 0.0
+    decoded_bytes: int = 0
+
+# Read the thumbnail from the cache, or decode the image, or use the already decoded one,
+# fit it to its slot and store it in the cache. Each phase is timed for the render metrics.
+# Defined at module level so it can be sent to a process pool
+def load_thumbnail(source: str | Image.Image,
+                   size: tuple[int, int],
+                   cache: ThumbnailCache | None = None,
+                   key: str | None = None,
+                   stretch: StretchMode = StretchMode.AUTO,
+                   quality: ResamplingQuality = ResamplingQuality.PRINT) -> LoadedThumbnail:
+    start = time.perf_counter()
+    if cache and key:
+        tile = cache.get(key)
+        if tile is not None:
+            return LoadedThumbnail(tile, True, time.perf_counter() - start)
+    looked_up = time.perf_counter()
+    image = load_image(source, size, stretch) if isinstance(source, str) else source
+    decoded = time.perf_counter()
+    tile = fit_image(image, size, quality)
+    fitted = time.perf_counter()
+    if cache and key:
+        cache.put(key, tile)
+    cache_time = looked_up - start + time.perf_counter() - fitted
+    decoded_bytes = image.width * image.height * len(image.getbands()) if isinstance(source, str) else 0
+    return LoadedThumbnail(tile, False, cache_time, decoded - looked_up, fitted - decoded, decoded_bytes)
+
+# Estimate the memory used while loading a thumbnail: the fitted tile, plus the decoded image
+# and its RGB conversion if it is not in the cache. Only the header of the file is read.
+def estimate_thumbnail_memory(source: str | Image.Image,
+                              size: tuple[int, int],
+                              cache: ThumbnailCache | None = None,
+                              key: str | None = None,
+                              stretch: StretchMode = StretchMode.AUTO,
+                              quality: ResamplingQuality = ResamplingQuality.PRINT) -> int:
+    tile_bytes = size[0] * size[1] * 3
+    if not isinstance(source, str) or (cache and key and os.path.exists(cache.get_file(key))):
+        return tile_bytes
+    try:
+        if is_fits_file(source):
+            from linear_images import estimate_linear_image_memory
+            return tile_bytes + estimate_linear_image_memory(source, size)
+        with Image.open(source) as img:
+            if img.format == "JPEG":
+                img.draft("RGB", size)
+            band_bytes = int(ImageMode.getmode(img.mode).typestr[-1])
+            decoded_bytes = img.width * img.height * (len(img.getbands()) * band_bytes + 3)
+    except (OSError, ValueError, KeyError):
+        return tile_bytes
+    return tile_bytes + decoded_bytes
+
+T = TypeVar("T")
+
+# Raised when a render is cancelled because a newer one superseded it
+class RenderCancelled(Exception):
+    pass
+
+# Run the jobs with the given loading mode and yield (num, path, result) in submission order,
+# the result being the exception raised if the job failed.
+# Raises RenderCancelled as soon as is_cancelled returns True, pending jobs are dropped.
+# With a memory limit, jobs are only submitted while the memory estimated for the jobs running
+# or waiting to be consumed stays under the limit, a job over the limit runs alone. A result
+# counts until the next one is requested, the caller is expected to release it by then.
+def run_jobs(func: Callable[..., T],
+             jobs: list[tuple[int, str, tuple[Any, ...]]],
+             mode: LoadingMode,
+             workers: int,
+             is_cancelled: Callable[[], bool] | None = None,
+             estimate_memory: Callable[..., int] | None = None,
+             memory_limit: int = 0) -> Iterator[tuple[int, str, T | Exception]]:
+    if mode == LoadingMode.SEQUENTIAL or workers <= 1 or len(jobs) <= 1:
+        for num, path, args in jobs:
+            if is_cancelled is not None and is_cancelled():
+                raise RenderCancelled()
+            try:
+                yield num, path, func(*args)
+            except Exception as e:
+                yield num, path, e
+        return
+
+    executor: Executor
+    if mode == LoadingMode.PROCESSES:
+        from concurrent.futures import ProcessPoolExecutor  # Imports multiprocessing, only when needed
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(jobs)))
+    else:
+        executor = ThreadPoolExecutor(max_workers=min(workers, len(jobs)))
+    limited = estimate_memory is not None and memory_limit > 0
+    with executor:
+        pending: deque[tuple[int, str, Future[T], int]] = deque()
+        pending_memory = 0
+        next_job = 0
+        next_memory: int | None = None
+        while pending or next_job < len(jobs):
+            # Submit the next jobs while they fit in the memory limit
+            while next_job < len(jobs):
+                num, path, args = jobs[next_job]
+                if next_memory is None:
+                    next_memory = estimate_memory(*args) if limited else 0  # type: ignore[misc]
+                if pending and limited and pending_memory + next_memory > memory_limit:
+                    break
+                pending.append((num, path, executor.submit(func, *args), next_memory))
+                pending_memory += next_memory
+                next_memory = None
+                next_job += 1
+
+            num, path, future, memory = pending.popleft()
+            if is_cancelled is not None and is_cancelled():
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise RenderCancelled()
+            try:
+                result: T | Exception = future.result()
+            except Exception as e:
+                result = e
+            del future
+            yield num, path, result
+            del result
+            pending_memory -= memory
+
+# Load images from the input folder with a name that starts with 'prefix' and followed by a number
+# Returns a dictionary mapping the number to the Image object
+# If the slot sizes are given, only the numbers with a slot are loaded, and images are decoded
+# at a reduced resolution when the format allows it
+def load_images(input_folder: str,
+                prefix: str,
+                slot_sizes: dict[int, tuple[int, int]] | None = None,
+                mode: LoadingMode = LoadingMode.SEQUENTIAL,
+                workers: int = 1,
+                metrics: RenderMetrics | None = None,
+                stretch: StretchMode = StretchMode.AUTO,
+                selection: ImageSelection = ImageSelection.NAME,
+                preferences: list[str] | tuple[str, ...] = ()) -> dict[int, Image.Image]:
+    with measure(metrics, "scan"):
+        jobs = [(num, path, (path, slot_sizes.get(num) if slot_sizes else None, stretch))
+                for num, path in find_images(input_folder, prefix, selection, preferences).items()
+                if slot_sizes is None or num in slot_sizes]
+    images: dict[int, Image.Image] = {}
+    with measure(metrics, "decode"):
+        for num, path, result in run_jobs(load_image, jobs, mode, workers):
+            if isinstance(result, Exception):
+                print(f"Error loading {os.path.basename(path)}: {result}")
+                continue
+            images[num] = result
+            if metrics is not None:
+                metrics.count("bytes_decoded", result.width * result.height * len(result.getbands()))
 
     print(f"Loaded {len(images)} image(s) with prefix '{prefix}' from '{input_folder}'.")
     return images
 
+# Load the given images already fitted to the slot size of their number and yield
+# (num, thumbnail) in the order of the entries, the thumbnail being None if it failed to load.
+# Fitted images are read from the cache when available, the source is only decoded on a miss.
+# Entries without a slot are skipped.
+# Sources are images already decoded by the caller, used instead of decoding their file again.
+# Thumbnails are loaded ahead within the memory limit only, so the caller can process and
+# release them one at a time.
+# With metrics, the cache hits and misses, tiles fitted, bytes decoded and the time spent in the
+# cache, decoding and fitting are recorded.
+# If every image is already decoded and fit_workers is given, they are fitted on that many threads
+# whatever the loading mode: resizing releases the GIL and threads don't copy the images to
+# worker processes. Results keep their order, so the mosaic is the same with any worker count.
+def iter_thumbnails(entries: list[tuple[int, str]],
+                    slot_sizes: dict[int, tuple[int, int]],
+                    cache: ThumbnailCache | None = None,
+                    mode: LoadingMode = LoadingMode.SEQUENTIAL,
+                    workers: int = 1,
+                    is_cancelled: Callable[[], bool] | None = None,
+                    sources: dict[int, Image.Image] | None = None,
+                    metrics: RenderMetrics | None = None,
+                    memory_limit: int = 0,
+                    stretch: StretchMode = StretchMode.AUTO,
+                    quality: ResamplingQuality = ResamplingQuality.PRINT,
+                    fit_workers: int = 0) -> Iterator[tuple[int, Image.Image | None]]:
+    jobs: list[tuple[int, str, tuple[Any, ...]]] = []
+    with measure(metrics, "cache"):
+        for num, path in entries:
+            if num not in slot_sizes:
+                continue
+            size = slot_sizes[num]
+            key = cache.make_key(path, size, f"{quality.value}|{stretch.value}") if cache else None
+            source = sources[num] if sources and num in sources else path
+            jobs.append((num, path, (source, size, cache, key, stretch, quality)))
+    if fit_workers > 0 and jobs and all(not isinstance(args[0], str) for _, _, args in jobs):
+        mode, workers = LoadingMode.THREADS, fit_workers
+
+    loaded = 0
+    cached = 0
+    for num, path, result in run_jobs(load_thumbnail, jobs, mode, workers, is_cancelled, estimate_thumbnail_memory, memory_limit):
+        if isinstance(result, Exception):
+            print(f"Error loading {os.path.basename(path)}: {result}")
+            yield num, None
+            continue
+        tile, hit = result.tile, result.cached
+        if metrics is not None:
+            metrics.add_time("cache", result.cache_time)
+            if hit:
+                metrics.count("cache_hits")
+            else:
+                if cache:
+                    metrics.count("cache_misses")
+                metrics.add_time("decode", result.decode_time)
+                metrics.add_time("fit", result.fit_time)
+                metrics.count("bytes_decoded", result.decoded_bytes)
+                metrics.count("tiles_fitted")
+        cached += hit
+        loaded += 1
+        del result
+        yield num, tile
+        del tile
+
+    if cache:
+        with measure(metrics, "cache"):
+            cache.evict()
+    print(f"Loaded {loaded} thumbnail(s) ({cached} from cache).")
+
+# Load the given images already fitted to the slot size of their number, see iter_thumbnails
+# Returns a dictionary mapping the number to the thumbnail, numbers that failed are left out
+def load_thumbnails(paths: dict[int, str],
+                    slot_sizes: dict[int, tuple[int, int]],
+                    cache: ThumbnailCache | None = None,
+                    mode: LoadingMode = LoadingMode.SEQUENTIAL,
+                    workers: int = 1,
+                    is_cancelled: Callable[[], bool] | None = None,
+                    sources: dict[int, Image.Image] | None = None,
+                    metrics: RenderMetrics | None = None,
+                    stretch: StretchMode = StretchMode.AUTO,
+                    quality: ResamplingQuality = ResamplingQuality.PRINT,
+                    fit_workers: int = 0) -> dict[int, Image.Image]:
+    thumbnails: dict[int, Image.Image] = {}
+    for num, tile in iter_thumbnails(list(paths.items()), slot_sizes, cache, mode, workers, is_cancelled, sources, metrics,
+                                     stretch=stretch, quality=quality, fit_workers=fit_workers):
+        if tile is not None:
+            thumbnails[num] = tile
+    return thumbnails
+
 # Convert a Pillow Image to base64 string for Flet.
 def pil_to_base64(pil_image: Image.Image) -> str:
     buffer = io.BytesIO()
     pil_image.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode("utf-8")
\ No newline at end of file
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+# Encodes the preview for Flet with a fast encoder (JPEG or WebP at the given quality, or PNG
+# with a low compression level), reusing the same buffer. The pixels are hashed so an unchanged
+# preview is not encoded again. Only meant for the preview, the export is saved by Pillow directly.
+class PreviewEncoder:
+    def __init__(self, format: str = PREVIEW_FORMAT, quality: int = PREVIEW_QUALITY):
+        format = format.upper()
+        if format == "WEBP" and not features.check("webp"):
+            format = "PNG"
+        self.format = format
+        self.quality = quality
+        self.buffer = io.BytesIO()
+        self.last_hash: bytes | None = None
+        self.last_result = ""
+
+    def get_save_options(self) -> dict[str, int | str | bool]:
+        if self.format == "PNG":
+            return {"compress_level": PREVIEW_PNG_COMPRESS_LEVEL}
+        if self.format == "WEBP":
+            return {"quality": self.quality, "method": 0}
+        return {"quality": self.quality, "subsampling": "4:2:0"}
+
+    def encode(self, pil_image: Image.Image) -> str:
+        digest = hashlib.blake2b(pil_image.tobytes(), digest_size=16)
+        digest.update(f"{pil_image.mode}{pil_image.size}".encode("utf-8"))
+        image_hash = digest.digest()
+        if image_hash == self.last_hash:
+            return self.last_result
+
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        pil_image.save(self.buffer, format=self.format, **self.get_save_options())
+        with self.buffer.getbuffer() as data:
+            self.last_result = base64.b64encode(data).decode("ascii")
+        self.last_hash = image_hash
+        return self.last_result